@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 # Copynaut
 #
-# Outstanding issues:
-# * Extracting content from indexed images does not preserve their palette.
-#   Because GIMP has a bug in indexization where, given a preset palette, some image colors that match exactly will be matched to some other color instead,
-#   this is not going to be fixed for the moment. When I decide it's okay to depend on NumPy, then we can use its binning functions to
-#   do indexization properly (since we know all matches will be exact matches, and there will be <= 256 of them.)
+# Notes:
+# * Clippings exported from indexed images keep their palette (png only). GIMP's custom-palette conversion
+#   sometimes matches exactly-matching colors to some other color, so this is done with NumPy instead,
+#   by _indexize(); all matches are exact matches, and there are <= 256 of them.
+#   Exports that go through GIMP's file plug-ins (eg. without NumPy) still use GIMP's conversion.
 #
 
 import os
@@ -15,13 +15,18 @@ from collections import namedtuple
 from contextlib import contextmanager
 
 Config = namedtuple('Config', 'stack export')
-StackConfig = namedtuple('StackConfig', 'read_index name_template name_edits')
-ExportConfig = namedtuple('ExportConfig', 'name_template name_edits directory webp_args jpeg_args')
+StackConfig = namedtuple('StackConfig', 'read_index name_template name_edits storage')
+ExportConfig = namedtuple('ExportConfig', 'name_template name_edits directory webp_args jpeg_args processes queue_size tmsu target trace')
+EncodeJob = namedtuple('EncodeJob', 'path ext pixels colormap webp_args jpeg_args')
+EncodeSummary = namedtuple('EncodeSummary', 'written failed skipped nbytes seconds')
+JournalEntry = namedtuple('JournalEntry', 'item hash path status')
+GridAnalysis = namedtuple('GridAnalysis', 'x y width height gridw gridh tiles keep colormap')
 
 _DEFAULT_CONFIG = """
 [clipping stack]
 mode = last-in-first-out
 name template = {basename_layerpath} {where}
+storage = buffers
 [clipping name edits]
 00_remove_doublebracketed_expressions = ;\[\[(.+)\]\];
 01_remove_trailing_spaces = / +$/
@@ -30,6 +35,11 @@ name template = {layerpath_multiple}.png
 directory =
 webp quality = 92
 jpeg quality = 92
+encode processes = 0
+encode queue = 32
+tmsu = tmsu
+target = files
+trace =
 [export name edits]
 00_remove_doublebracketed_expressions = /\[\[(.+)\]\]/
 01_remove_trailing_spaces = / +$/
@@ -37,7 +47,10 @@ jpeg quality = 92
 03_shellcharacters_to_underscore = ,[ !#$^&*;()[\]|]+,_
 """
 
+# (config.ini mtime, Config)
 _config_cache = None
+# tuple of name edits -> compiled pipeline, see _name_edit_pipeline()
+_name_edit_pipelines = {}
 _re_flagmap = {v.lower(): getattr(re, v) for v in [f for f in dir(re) if (not f == 'T') and len(f) == 1 and f.isupper()]}
 
 gettext.install("gimp20-python", gimp.locale_directory, unicode=True)
@@ -132,34 +145,234 @@ def _serialize_regex_repl(tup):
 def _getconfigpath():
     return os.path.join(gimp.directory, 'copynaut', 'config.ini')
 
+def _getconfigmtime():
+    try:
+        return os.stat(_getconfigpath()).st_mtime
+    except OSError:
+        return None
+
 @contextmanager
 def undogroup(image):
     pdb.gimp_image_undo_group_start(image)
     yield
     pdb.gimp_image_undo_group_end(image)
 
+class _ExportBatch(object):
+    """State shared by all the exports in one operation.
+
+    template_vars  (image ID, drawable ID, nlayers) -> template variables that don't depend on the selection
+    layer_paths    _LayerPaths for the layerpath template variables
+    filenames      _FilenameAllocator for export paths
+    encoder        _Encoder that writes the exported files
+    tagger         _Tagger for the exported files
+    journal        _Journal of the source image, if the batch can be resumed
+    cache          _ExportCache of previously exported clippings
+    target         _PackedTarget collecting the clippings, unless they go to separate files
+    trace          _Trace of the exports, or a _NullTrace
+    summary        EncodeSummary, once the batch has finished
+    """
+    def __init__(self, image, journal=False):
+        conf = _load_config(image.filename)
+        self.image = image
+        self.template_vars = {}
+        self.layer_paths = _LayerPaths()
+        self.filenames = _FilenameAllocator()
+        self.encoder = _Encoder(conf.export.processes, conf.export.queue_size)
+        self.tagger = _Tagger(conf.export.tmsu)
+        self.journal = _Journal(image.filename) if journal and image.filename else None
+        self.cache = _ExportCache()
+        self.target = _packed_target(self, conf)
+        self.trace = _Trace(conf.export.trace) if conf.export.trace else _NullTrace()
+        self.summary = None
+
+    def close(self):
+        try:
+            if self.target is not None:
+                with self.trace.stage('pack'):
+                    self.target.close()
+            with self.trace.stage('encode'):
+                self.summary = self.encoder.finish()
+            with self.trace.stage('tag'):
+                self.tagger.flush()
+        finally:
+            self.trace.close(self.summary)
+            self.cache.close()
+            if self.journal is not None:
+                self.journal.close()
+
+_batch = None
+
+class _CountingPDB(object):
+    """Stands in for pdb, counting the procedure calls made through it."""
+    def __init__(self, pdb):
+        self.pdb = pdb
+        self.calls = 0
+        # procedure name -> number of calls
+        self.counts = {}
+
+    def __getattr__(self, name):
+        proc = getattr(self.pdb, name)
+        def call(*args, **kwargs):
+            self.calls += 1
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return proc(*args, **kwargs)
+        return call
+
+class _Trace(object):
+    """Times the stages of each export, and counts the PDB calls made in them (see the 'trace' setting).
+
+    While the trace is open, the module's pdb is a _CountingPDB. Stages outside of
+    begin() .. end() only count towards the totals written by close().
+    """
+    def __init__(self, path):
+        global pdb
+        from collections import OrderedDict
+        self.path = path
+        self.pdb = pdb = _CountingPDB(pdb)
+        self.file = None
+        self.clippings = 0
+        # (info, stages, start time, PDB calls, PDB calls by procedure) of the current clipping
+        self.record = None
+        # stage name -> [seconds, PDB calls]
+        self.totals = OrderedDict()
+
+    def begin(self, **info):
+        import time
+        from collections import OrderedDict
+        self.record = (info, OrderedDict(), time.time(), self.pdb.calls, dict(self.pdb.counts))
+
+    @contextmanager
+    def stage(self, name):
+        import time
+        start, calls = time.time(), self.pdb.calls
+        try:
+            yield
+        finally:
+            seconds, calls = time.time() - start, self.pdb.calls - calls
+            for stages in (self.totals, self.record[1] if self.record else None):
+                if stages is not None:
+                    total = stages.setdefault(name, [0.0, 0])
+                    total[0] += seconds
+                    total[1] += calls
+
+    def _write(self, record):
+        import json
+        if self.file is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps(record) + '\n')
+
+    def end(self, **info):
+        import time
+        from collections import OrderedDict
+        begun, stages, start, calls, counts = self.record
+        self.record = None
+        self.clippings += 1
+        record = OrderedDict(sorted(begun.items()) + sorted(info.items()))
+        record['seconds'] = time.time() - start
+        record['pdb calls'] = self.pdb.calls - calls
+        record['stages'] = OrderedDict((k, {'seconds': s, 'pdb calls': n}) for k, (s, n) in stages.items())
+        record['pdb'] = dict((k, n - counts.get(k, 0)) for k, n in self.pdb.counts.items() if n != counts.get(k, 0))
+        self._write(record)
+
+    def close(self, summary=None):
+        """Write the totals, along with the batch's EncodeSummary if given, and put pdb back."""
+        global pdb
+        from collections import OrderedDict
+        pdb = self.pdb.pdb
+        try:
+            totals = OrderedDict([('clippings', self.clippings)])
+            if summary is not None:
+                totals.update(summary._asdict())
+                totals['encode seconds'] = totals.pop('seconds')
+            totals['pdb calls'] = self.pdb.calls
+            totals['stages'] = OrderedDict((k, {'seconds': s, 'pdb calls': n}) for k, (s, n) in self.totals.items())
+            totals['pdb'] = self.pdb.counts
+            self._write({'summary': totals})
+        finally:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class _NullTrace(object):
+    """Stands in for a _Trace when tracing is off."""
+    def begin(self, **info):
+        pass
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def end(self, **info):
+        pass
+
+    def close(self, summary=None):
+        pass
+
+@contextmanager
+def export_batch(image, journal=False):
+    """Group the exports made within the context into a single batch.
+
+    With journal, clippings already exported unchanged by an earlier (possibly interrupted)
+    batch on the same image are skipped, and changed ones overwrite their earlier export.
+    A batch nested in another just joins the outer one.
+    """
+    global _batch
+    if _batch is not None:
+        yield _batch
+        return
+    batch = _batch = _ExportBatch(image, journal)
+    try:
+        yield batch
+    finally:
+        # exports may still be completing, so stay current until closed
+        try:
+            batch.close()
+        finally:
+            _batch = None
+
+def _report(summary):
+    """Show the EncodeSummary of a finished batch."""
+    msg = 'Exported %d files (%.1f kB).' % (summary.written, summary.nbytes / 1024.)
+    if summary.skipped:
+        msg += ' %d unchanged clippings skipped.' % summary.skipped
+    if summary.failed:
+        msg += ' %d exports failed.' % summary.failed
+    pdb.gimp_message(msg)
+
 def iterate_layer_visibility(image, keep_bg=False):
+    # Each step only hides the previous layer and shows the next one,
+    # so a whole iteration costs O(n) visibility changes.
     saved_visibility = [(l, l.visible) for l in image.layers]
     working_set = image.layers
     if keep_bg:
         working_set = image.layers[:-1]
         image.layers[-1].visible = True
-    for i, layer in enumerate(working_set):
+    try:
         for l in working_set:
-            if l != layer:
+            if l.visible:
                 l.visible = False
-            else:
-                l.visible = True
-        yield (i, layer)
-    for l, vis in saved_visibility:
-        l.visible = vis
+        previous = None
+        for i, layer in enumerate(working_set):
+            if previous is not None:
+                previous.visible = False
+            layer.visible = True
+            previous = layer
+            yield (i, layer)
+    finally:
+        for l, vis in saved_visibility:
+            if l.visible != vis:
+                l.visible = vis
 
 # config
 
 def _load_config(extra_search_path):
     global _config_cache
-    if _config_cache is not None:
-        return _config_cache
+    mtime = _getconfigmtime()
+    if _config_cache is not None and _config_cache[0] == mtime:
+        return _config_cache[1]
     # python2 uses 'ConfigParser' module name
     # and has no read_string method
     from ConfigParser import RawConfigParser
@@ -180,10 +393,20 @@ def _load_config(extra_search_path):
     else:
         raise ValueError('Unknown value for clipping stack mode: %r' % s_mode)
     s_template = cstack('name template')
+    s_storage = cstack('storage').lower()
+    if s_storage not in ('buffers', 'disk'):
+        raise ValueError('Unknown value for clipping stack storage: %r' % s_storage)
     e_template = cexport('name template')
     e_directory = os.path.expanduser(cexport('directory'))
     e_webp_args = (int(cexport('webp quality')), )
     e_jpeg_args = (float(cexport('jpeg quality')) / 100., 0.0, 1, 1, "Exported by Copynaut", 1, 1, 0, 0 )
+    e_processes = int(os.environ.get('COPYNAUT_ENCODE_PROCESSES') or cexport('encode processes'))
+    e_queue_size = max(1, int(cexport('encode queue')))
+    e_tmsu = cexport('tmsu')
+    e_target = cexport('target').lower()
+    if e_target not in ('files', 'atlas', 'tar', 'zip'):
+        raise ValueError('Unknown value for export target: %r' % e_target)
+    e_trace = os.path.expanduser(cexport('trace'))
     s_name_edits = []
     e_name_edits = []
     for key in sorted(c.options('clipping name edits')):
@@ -194,11 +417,15 @@ def _load_config(extra_search_path):
         unparsed = c.get('export name edits', key)
         data = _split_regex_replacement(unparsed)
         e_name_edits.append((key, data))
-    stackc = StackConfig(read_index, s_template, s_name_edits)
-    exportc = ExportConfig(e_template, e_name_edits, e_directory, e_webp_args, e_jpeg_args)
+    # compile now, so invalid expressions are reported when the config is loaded
+    _name_edit_pipeline(s_name_edits)
+    _name_edit_pipeline(e_name_edits)
+    stackc = StackConfig(read_index, s_template, s_name_edits, s_storage)
+    exportc = ExportConfig(e_template, e_name_edits, e_directory, e_webp_args, e_jpeg_args,
+                           e_processes, e_queue_size, e_tmsu, e_target, e_trace)
     data = Config(stackc, exportc)
-    _config_cache = data
-    return _config_cache
+    _config_cache = (mtime, data)
+    return data
 
 def _save_config(cfg, filename):
     DOCS = """# CONFIGURATION
@@ -274,6 +501,16 @@ def _save_config(cfg, filename):
 # or 'first-in-first-out'
 #   (the first clipping you put on the stack is the first one to come out)
 #
+# 'storage' may be either 'buffers'
+#   (clippings are GIMP named buffers, held in GIMP's memory until it quits)
+# or 'disk'
+#   (clippings are raw pixel files under copynaut/stack in your GIMP profile
+#   directory, which survive restarting GIMP; requires NumPy.)
+#
+# Either way, copynaut keeps an index of the clippings it put on the stack -- which image and
+# layer each came from, its size and when it was copied -- so that 'Paste Matching Named and Remove'
+# can pick out clippings by name or layer path. Buffers made by other means aren't in the index.
+#
 #
 ##
 # [clipping name edits] section
@@ -348,6 +585,47 @@ def _save_config(cfg, filename):
 #   A number 0-100, controlling webp output quality.Only takes effect if you
 #   have specified webp output file format.
 #
+# 'encode processes':
+#   Number of processes used to encode and write exported files in parallel
+#   with extracting the next clipping. 0 means one per CPU, 1 means encode
+#   in the plug-in process, one clipping after another. No processes are
+#   started for an export that produces a single file.
+#   The COPYNAUT_ENCODE_PROCESSES environment variable overrides this setting;
+#   copynaut_batch.py sets it for its workers (see its --encode-processes).
+#   Encoding outside GIMP requires NumPy, and Python Imaging Library (Pillow)
+#   for .webp and .jpg; other cases are always encoded by GIMP.
+#
+# 'encode queue':
+#   Maximum number of clippings waiting to be encoded. Each one holds its
+#   pixels in memory until it is written, so this bounds memory use.
+#
+# 'tmsu':
+#   The tmsu command used to tag exported files with information about
+#   their source (see https://tmsu.org). Files are tagged in bulk when
+#   an export operation finishes.
+#
+# 'target':
+#   Where the clippings of one export operation go:
+#     files  a file per clipping, named by 'name template'.
+#     atlas  a single sprite sheet, {basename}-atlas{ext}, with a JSON
+#            sidecar listing the rectangle of each clipping by the file
+#            name it would have had.
+#     tar    a single uncompressed archive, {basename}-clippings.tar,
+#            holding a file per clipping.
+#     zip    the same, as {basename}-clippings.zip.
+#   Sheets and archives are placed in the directory of the first clipping,
+#   and are not tagged. They need NumPy; clippings that can only be
+#   encoded by GIMP are still written to separate files.
+#
+# 'trace':
+#   '' (the default) -> no tracing.
+#   Otherwise, the path of a file to append timings of export operations to,
+#   for finding out what makes them slow. Each exported clipping gets a
+#   JSON line with the seconds spent, and the number of PDB calls made,
+#   in each stage of its export (name, extract, copy, paste, colortoalpha,
+#   autocrop, indexize, journal, submit, export, cleanup), and each
+#   operation a final line with the totals under 'summary'.
+#
 ##
 # [export name edits] section
 #
@@ -369,11 +647,17 @@ def _save_config(cfg, filename):
     for k, v in (('webp quality', cfg.export.webp_args[0]),
                  ('jpeg quality', int(cfg.export.jpeg_args[0] * 100)),
                  ('name template', cfg.export.name_template),
-                 ('directory', cfg.export.directory)):
+                 ('directory', cfg.export.directory),
+                 ('encode processes', cfg.export.processes),
+                 ('encode queue', cfg.export.queue_size),
+                 ('tmsu', cfg.export.tmsu),
+                 ('target', cfg.export.target),
+                 ('trace', cfg.export.trace)):
         c.set('export', k, v)
 
     for k, v in (('mode', 'last-in-first-out' if cfg.stack.read_index == 0 else 'first-in-first-out'),
-                 ('name template', cfg.stack.name_template)):
+                 ('name template', cfg.stack.name_template),
+                 ('storage', cfg.stack.storage)):
         c.set('clipping stack', k, v)
 
     for k, v in cfg.export.name_edits:
@@ -409,11 +693,41 @@ def _get_layer_path(item):
         tmp = tmp + '/'
     return tmp
 
+class _LayerPaths(object):
+    """Computes layer paths like _get_layer_path(), remembering the path of every item on the way.
 
-def _subst_preprocess(format_str, data):
-    """Applies replacements specified in format_str to keys in data.
+    The ancestors of an item are walked only as far as the first one already seen, so over a
+    batch, each layer group is looked up once, however many of its layers are exported.
+    """
+    def __init__(self):
+        # item ID -> layer path, without the trailing '/' of layer groups
+        self.paths = {}
+
+    def _path(self, item):
+        path = self.paths.get(item.ID)
+        if path is None:
+            path = _escape(item.name)
+            parent = pdb.gimp_item_get_parent(item)
+            if parent:
+                path = self._path(parent) + '/' + path
+            self.paths[item.ID] = path
+        return path
 
-    Returns new format string (with non-standard replacement specifiers removed).
+    def __call__(self, item):
+        path = self._path(item)
+        if pdb.gimp_item_is_group(item):
+            path = path + '/'
+        return path
+
+
+_subst_re = re.compile('[{]([^/]+)/((?:[^}]|\\[}])+)[}]')
+_subst_split_re = re.compile(r'(?!<[\\])/')
+
+def _subst_parse(format_str):
+    """Parses the replacements specified in format_str.
+
+    Returns (new format string with non-standard replacement specifiers removed,
+             list of (name, pattern, replacement) tuples).
 
     Format:
      {SPEC/str/repl[/str/repl...]}
@@ -421,25 +735,200 @@ def _subst_preprocess(format_str, data):
     Literal /'s and }'s must be escaped using \.
     """
     replacements = []
-    import re
     from itertools import groupby
     def add_repls(match):
         name = match.expand('\\1')
         data = match.expand('\\2')
         data = data.replace('\\}', '}')
-        pairs = re.split(r'(?!<[\\])/', data)
+        pairs = _subst_split_re.split(data)
         if len(pairs) % 2:
             raise ValueError('Incomplete substitution in %r' % ('%s/%s' % (name, data)))
         for s, r in [list([v2 for k2,v2 in v]) for k, v in  groupby(enumerate(pairs), lambda i: i[0] // 2)]:
             replacements.append((name, s,r))
         return '{%s}' % name
-    result = re.sub('[{]([^/]+)/((?:[^}]|\\[}])+)[}]', add_repls, format_str)
-    for name, pattern, replacement in replacements:
-        data[name] = data[name].replace(pattern, replacement)
-    return result
+    result = _subst_re.sub(add_repls, format_str)
+    return result, replacements
+
+def _template_fields(format_str):
+    """Yield the names of the variables referenced by a str.format() format string."""
+    from string import Formatter
+    for literal, field, spec, conversion in Formatter().parse(format_str):
+        if field:
+            name = re.match(r'[^.\[]*', field).group(0)
+            if name and not name.isdigit():
+                yield name
+        if spec:
+            for name in _template_fields(spec):
+                yield name
+
+
+class _TemplateVars(object):
+    """Lazily computes template variables for one drawable.
+
+    Each variable is computed at most once. Variables that don't depend on the selection mask or
+    vectors are kept in 'static', which can be shared between expansions for the same drawable.
+    """
+    _dynamic = frozenset(['mpixels', 'kpixels', 'width', 'height', 'size', 'offsets',
+                          'offsetx', 'offsety', 'where', 'vectors', '_mask_bounds'])
+
+    def __init__(self, image, drawable, vectors, nlayers, static=None, bounds=None):
+        self.image = image
+        self.drawable = drawable
+        self.vectors = vectors
+        self.nlayers = nlayers
+        self.static = {} if static is None else static
+        self.local = {}
+        if bounds is not None:
+            self.local['_mask_bounds'] = bounds
+
+    def __getitem__(self, name):
+        memo = self.local if name in self._dynamic else self.static
+        try:
+            return memo[name]
+        except KeyError:
+            pass
+        func = getattr(self, '_var_' + name, None)
+        if func is None:
+            raise KeyError(name)
+        value = memo[name] = func()
+        return value
+
+    def _var__filename(self):
+        return self.image.filename or '<none>'
+
+    def _var__splitpath(self):
+        return _splitext(self['_filename'])
+
+    def _var_path(self):
+        return self['_splitpath'][0]
+
+    def _var_ext(self):
+        return self['_splitpath'][1]
+
+    def _var_basename(self):
+        return os.path.basename(self['path'])
 
+    def _var_realpath(self):
+        return _splitext(os.path.realpath(self['_filename']))[0]
 
-def _expand_template(image, drawable, vectors, template, nlayers):
+    def _var_layername(self):
+        return self.drawable.name
+
+    def _var_layerpath(self):
+        if _batch is not None:
+            return _batch.layer_paths(self.drawable)
+        return _get_layer_path(self.drawable)
+
+    def _var_layerpath_multiple(self):
+        return '' if self.nlayers == 1 else self['layerpath']
+
+    def _var_basename_layerpath(self):
+        if os.path.basename(self['_filename']) != self['layerpath']:
+            return self['basename'] + ':' + self['layerpath']
+        return self['basename']
+
+    def _var_alpha(self):
+        alpha = 'A' if self.drawable.has_alpha else ''
+        if self.drawable.mask:
+            alpha += '*'
+        return alpha
+
+    def _var_type(self):
+        t = self.drawable.type
+        if t in (RGB_IMAGE, RGBA_IMAGE):
+            return 'RGB'
+        elif t in (GRAY_IMAGE, GRAYA_IMAGE):
+            return 'Y'
+        elif t in (INDEXED_IMAGE, INDEXEDA_IMAGE):
+            return 'I'
+        return '<unknown type>'
+
+    def _var_nchildren(self):
+        if pdb.gimp_item_is_group(self.drawable):
+            return len(self.drawable.children)
+        return ''
+
+    def _var_ismask(self):
+        return 'M' if self.drawable.is_layer_mask else ''
+
+    def _var_isize(self):
+        return '%dx%d' % (self.image.width, self.image.height)
+
+    def _var_image(self):
+        return self.image
+
+    def _var_drawable(self):
+        return self.drawable
+
+    def _var__mask_bounds(self):
+        return self.drawable.mask_bounds
+
+    def _var_mpixels(self):
+        x1, y1, x2, y2 = self['_mask_bounds']
+        return '%.1f' % ((x2 - x1) * (y2 - y1) / 1048576.)
+
+    def _var_kpixels(self):
+        x1, y1, x2, y2 = self['_mask_bounds']
+        return '%.1f' % ((x2 - x1) * (y2 - y1) / 1024.)
+
+    def _var_width(self):
+        x1, y1, x2, y2 = self['_mask_bounds']
+        return x2 - x1
+
+    def _var_height(self):
+        x1, y1, x2, y2 = self['_mask_bounds']
+        return y2 - y1
+
+    def _var_size(self):
+        return '%dx%d' % (self['width'], self['height'])
+
+    def _var_offsetx(self):
+        return self['_mask_bounds'][0]
+
+    def _var_offsety(self):
+        return self['_mask_bounds'][1]
+
+    def _var_offsets(self):
+        return '%d,%d' % (self['offsetx'], self['offsety'])
+
+    def _var_where(self):
+        return '[[%s+%s]]' % (self['isize'], self['offsets'])
+
+    def _var_vectors(self):
+        return self.vectors.name if self.vectors else ''
+
+
+class _Template(object):
+    """A name template, parsed once.
+
+    Expanding it computes only the variables it references.
+    """
+    def __init__(self, template):
+        self.format, replacements = _subst_parse(template)
+        self.fields = frozenset(_template_fields(self.format))
+        self.replacements = {}
+        for name, pattern, replacement in replacements:
+            self.replacements.setdefault(name, []).append((pattern, replacement))
+
+    def expand(self, vars):
+        data = {}
+        for name in self.fields:
+            value = vars[name]
+            for pattern, replacement in self.replacements.get(name, ()):
+                value = value.replace(pattern, replacement)
+            data[name] = value
+        return self.format.format(**data)
+
+_compiled_templates = {}
+
+def _compile_template(template):
+    compiled = _compiled_templates.get(template)
+    if compiled is None:
+        compiled = _compiled_templates[template] = _Template(template)
+    return compiled
+
+
+def _expand_template(image, drawable, vectors, template, nlayers, bounds=None):
     """Expand the string template, returning the semi-final name of the buffer
     (*semi*-final because GIMP may still generate a #n suffix if multiple of the name occurs)
 
@@ -476,96 +965,224 @@ def _expand_template(image, drawable, vectors, template, nlayers):
       ismask      'M' if the source drawable is a layer mask
       vectors     name of vectors object passed to _expand_template ('' if vectors is None)
 
+    The clipping area is the selection bounds within drawable, unless bounds (x1, y1, x2, y2) is given.
     """
-    filename = image.filename or '<none>'
-    _basename = os.path.basename(filename)
-    layername = drawable.name
-    layerpath = _get_layer_path(drawable)
-    path, ext = _splitext(filename)
-    mpixels = '<you should never see this>'
-    kpixels = mpixels
-    if 'mpixels' in template or 'kpixels' in template:
-         nonempty, x1, y1, x2, y2 = pdb.gimp_drawable_mask_bounds(drawable)
-         w = x2 - x1
-         h = y2 - y1
-         pixels = w * h
-         kpixels = '%.1f' % (pixels / 1024.)
-         mpixels = '%.1f' % (pixels / 1048576.)
-    basename = os.path.basename(path)
-    if _basename != layerpath:
-         basename_layerpath = basename + ':' + layerpath
-    else:
-         basename_layerpath = basename
-
-    alpha = 'A' if drawable.has_alpha else ''
-    if drawable.mask:
-        alpha += '*'
-    _type = '<unknown type>'
-    if drawable.type in (RGB_IMAGE, RGBA_IMAGE):
-         _type = 'RGB'
-    elif drawable.type in (GRAY_IMAGE, GRAYA_IMAGE):
-         _type = 'Y'
-    elif drawable.type in (INDEXED_IMAGE, INDEXEDA_IMAGE):
-         _type = 'I'
-    nchildren = ''
-    if pdb.gimp_item_is_group(drawable):
-        nchildren = len(drawable.children)
-    width = '<you should never see this>'
-    height = width
-    size = width
-    offsetx, offsety = 0, 0
-    if 'width' in template or 'height' in template or 'size' in template or 'offset' in template:
-        x1, y1, x2, y2 = drawable.mask_bounds
-        width = x2 - x1
-        height = y2 - y1
-        size = '%dx%d' % (width, height)
-        offsetx, offsety = x1, y1
-    offsets = '%d,%d' % (offsetx, offsety)
-    ismask = 'M' if drawable.is_layer_mask else ''
-    isize = '%dx%d' % (image.width, image.height)
-    where = '[[%s+%s]]' % (isize, offsets)
-    layerpath_multiple = '' if nlayers == 1 else layerpath
-    _vectors = ''
-    if vectors:
-        _vectors = vectors.name
-    data = dict(path=path,
-                ext=ext,
-                basename=basename,
-                realpath=_splitext(os.path.realpath(filename))[0],
-                mpixels=mpixels,
-                kpixels=kpixels,
-                layername=layername,
-                layerpath=layerpath,
-                basename_layerpath=basename_layerpath,
-                image=image,
-                drawable=drawable,
-                type=_type,
-                alpha=alpha,
-                nchildren=nchildren,
-                isize=isize,
-                where=where,
-                width=width,
-                height=height,
-                size=size,
-                offsets=offsets,
-                offsetx=offsetx,
-                offsety=offsety,
-                ismask=ismask,
-                layerpath_multiple=layerpath_multiple,
-                vectors=vectors)
-    newtemplate = _subst_preprocess(template, data)
+    static = None
+    if _batch is not None:
+        static = _batch.template_vars.setdefault((image.ID, drawable.ID, nlayers), {})
+    vars = _TemplateVars(image, drawable, vectors, nlayers, static, bounds)
     try:
-         return newtemplate.format(**data)
+         return _compile_template(template).expand(vars)
     except error:
          return 'Error expanding %r. Template may be invalid.'
 
+def _name_edit_pipeline(replacements):
+    """Return a function applying the (name, (regexp, repl, flags)) replacements to a string, in order.
+
+    Each distinct chain of replacements is compiled only once.
+    """
+    key = tuple(replacements)
+    pipeline = _name_edit_pipelines.get(key)
+    if pipeline is None:
+        subs = [(re.compile(src, flags).sub, repl) for name, (src, repl, flags) in replacements]
+        def pipeline(s):
+            for sub, repl in subs:
+                s = sub(repl, s)
+            return s
+        _name_edit_pipelines[key] = pipeline
+    return pipeline
+
 def _apply_regexp_substitutions(s, replacements):
-    import re
-    final = s
-    for name, v in replacements:
-        src, repl, flags = v
-        final = re.sub(src, repl, final, flags=flags)
-    return final
+    return _name_edit_pipeline(replacements)(s)
+
+StackEntry = namedtuple('StackEntry', 'id name width height bpp colormap source layerpath time')
+BufferEntry = namedtuple('BufferEntry', 'name width height source layerpath time')
+
+def _stack_source(image):
+    """Identify image as the source of a clipping: its file's real path, or its ID while it is unsaved."""
+    if image.filename:
+        return os.path.realpath(image.filename)
+    return 'image:%d' % image.ID
+
+class _StackIndex(object):
+    """Entries (of type entry_type) describing the clippings on the stack, newest first.
+
+    They are kept as JSON in filename under copynaut/stack in the GIMP profile, and updated as clippings
+    are pushed and popped. Fields missing from entries written by older versions take their value from defaults.
+    """
+    entry_type = None
+    defaults = dict(source='', layerpath='', time=0.0)
+
+    def __init__(self, filename):
+        import json
+        self.directory = os.path.join(gimp.directory, 'copynaut', 'stack')
+        self.index = os.path.join(self.directory, filename)
+        fields = self.entry_type._fields
+        try:
+            with open(self.index) as f:
+                stored = json.load(f)
+        except IOError:
+            stored = []
+        self.entries = []
+        for e in stored:
+            e = [v.encode('utf-8') if isinstance(v, unicode) else v for v in e]
+            self.entries.append(self.entry_type(*(e + [self.defaults[k] for k in fields[len(e):]])))
+
+    def _save(self):
+        import json
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        temp = self.index + '.new'
+        with open(temp, 'w') as f:
+            json.dump(self.entries, f)
+        if os.name != 'posix' and os.path.exists(self.index):
+            os.remove(self.index)
+        os.rename(temp, self.index)
+
+    def names(self):
+        return [e.name for e in self.entries]
+
+    def matching(self, pattern='', source=None):
+        """Return the entries whose name or layer path matches the glob pattern ('' matches all),
+        copied from source (see _stack_source), if given. Newest first."""
+        from fnmatch import fnmatchcase
+        return [e for e in self.entries
+                if (not pattern or fnmatchcase(e.name, pattern) or fnmatchcase(e.layerpath, pattern))
+                and (source is None or e.source == source)]
+
+class _BufferIndex(_StackIndex):
+    """Index of the clippings copynaut put in named buffers, in copynaut/stack/buffers.json.
+
+    GIMP forgets its buffers when it quits, and they may be deleted from its Buffers dialog, so
+    the index can list buffers that are gone. push() and matching() drop those, checking against
+    the buffer list, so the index never lists more than the buffers GIMP currently has.
+    """
+    entry_type = BufferEntry
+
+    def __init__(self):
+        _StackIndex.__init__(self, 'buffers.json')
+
+    def _prune(self):
+        """Drop entries whose buffers are gone. Return whether any were."""
+        _, live = pdb.gimp_buffers_get_list('')
+        live = set(live)
+        kept = [e for e in self.entries if e.name in live]
+        pruned = len(kept) != len(self.entries)
+        self.entries = kept
+        return pruned
+
+    def push(self, name, source, layerpath):
+        """Record buffer name, as just copied from layerpath in source."""
+        import time
+        entry = BufferEntry(name, pdb.gimp_buffer_get_width(name), pdb.gimp_buffer_get_height(name),
+                            source, layerpath, time.time())
+        self._prune()
+        # a buffer that was replaced under the same name is no longer the one we indexed
+        self.entries = [entry] + [e for e in self.entries if e.name != name]
+        self._save()
+        return entry
+
+    def remove(self, names):
+        names = set(names)
+        if any(e.name in names for e in self.entries):
+            self.entries = [e for e in self.entries if e.name not in names]
+            self._save()
+
+    def matching(self, pattern='', source=None):
+        if self._prune():
+            self._save()
+        return _StackIndex.matching(self, pattern, source)
+
+class _DiskStack(_StackIndex):
+    """Clipping stack kept on disk, under copynaut/stack in the GIMP profile.
+
+    index.json lists the entries, newest first, as the buffer list does. Each entry's pixels are
+    stored raw in <id>.raw, and read back through a memory map; <id>.png is a thumbnail.
+    colormap is a hex string for clippings of indexed drawables, '' otherwise.
+    """
+    entry_type = StackEntry
+    thumbnail_size = 64
+
+    def __init__(self):
+        _StackIndex.__init__(self, 'index.json')
+
+    def _file(self, entry, ext):
+        return os.path.join(self.directory, entry.id + ext)
+
+    def push(self, name, pixels, colormap=None, source='', layerpath=''):
+        """Store pixels (as returned by _extract_clipping), copied from layerpath in source, as the newest clipping."""
+        import numpy as np
+        import time
+        from binascii import hexlify
+        from uuid import uuid4
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        h, w, bpp = pixels.shape
+        entry = StackEntry(uuid4().hex, name, w, h, bpp, hexlify(colormap) if colormap is not None else '',
+                           source, layerpath, time.time())
+        raw = np.memmap(self._file(entry, '.raw'), dtype=np.uint8, mode='w+', shape=pixels.shape)
+        raw[:] = pixels
+        raw.flush()
+        del raw
+        step = -(-max(w, h) // self.thumbnail_size)
+        with open(self._file(entry, '.png'), 'wb') as f:
+            f.write(_png_bytes(np.ascontiguousarray(pixels[::step, ::step]), colormap))
+        self.entries.insert(0, entry)
+        self._save()
+        return entry
+
+    def pixels(self, entry):
+        """Return a read-only memory map of entry's pixels."""
+        import numpy as np
+        return np.memmap(self._file(entry, '.raw'), dtype=np.uint8, mode='r', shape=(entry.height, entry.width, entry.bpp))
+
+    def remove(self, entries):
+        """Remove entries from the stack, deleting their files."""
+        ids = set(e.id for e in entries)
+        self.entries = [e for e in self.entries if e.id not in ids]
+        self._save()
+        for e in entries:
+            for ext in ('.raw', '.png'):
+                try:
+                    os.remove(self._file(e, ext))
+                except OSError:
+                    pass
+
+    def to_buffer(self, entry):
+        """Copy entry into a new named buffer, and return the buffer's name."""
+        from binascii import unhexlify
+        base_type = INDEXED if entry.colormap else (RGB if entry.bpp >= 3 else GRAY)
+        layer_type = {(RGB, 3): RGB_IMAGE, (RGB, 4): RGBA_IMAGE, (GRAY, 1): GRAY_IMAGE, (GRAY, 2): GRAYA_IMAGE,
+                      (INDEXED, 1): INDEXED_IMAGE, (INDEXED, 2): INDEXEDA_IMAGE}[base_type, entry.bpp]
+        temp = gimp.Image(entry.width, entry.height, base_type)
+        try:
+            if entry.colormap:
+                colormap = unhexlify(entry.colormap)
+                pdb.gimp_image_set_colormap(temp, len(colormap), colormap)
+            layer = gimp.Layer(temp, entry.name, entry.width, entry.height, layer_type, 100, NORMAL_MODE)
+            temp.add_layer(layer, 0)
+            rgn = layer.get_pixel_rgn(0, 0, entry.width, entry.height, True, False)
+            raw = self.pixels(entry)
+            # a strip at a time, so the whole clipping is never in memory at once
+            for y in range(0, entry.height, 64):
+                y2 = min(entry.height, y + 64)
+                rgn[0:entry.width, y:y2] = raw[y:y2].tostring()
+            del raw
+            layer.flush()
+            return pdb.gimp_edit_named_copy(layer, entry.name)
+        finally:
+            pdb.gimp_image_delete(temp)
+
+def _disk_stack(conf):
+    """Return a _DiskStack if conf stores the clipping stack on disk and that is possible, otherwise None."""
+    if conf.stack.storage != 'disk':
+        return None
+    try:
+        import numpy
+    except ImportError:
+        pdb.gimp_message('Storing clippings on disk requires NumPy; using named buffers instead.')
+        return None
+    return _DiskStack()
 
 def _copyn(image, drawable, visible=False):
     # ugh, why is drawable usually None????
@@ -577,10 +1194,21 @@ def _copyn(image, drawable, visible=False):
         nlayers = 1
     used = _expand_template(image, drawable, None, conf.stack.name_template, nlayers)
     print('I,D:', image, drawable)
+    source, layerpath = _stack_source(image), _get_layer_path(drawable)
+    stack = _disk_stack(conf)
+    if stack is not None:
+        clipping = _extract_clipping(image, drawable, visible)
+        if clipping is None:
+            pdb.gimp_message('Nothing to copy: the selection doesn\'t intersect %s.' % drawable.name)
+            return
+        stack.push(used, clipping[0], clipping[1], source, layerpath)
+        return
     if visible:
-        pdb.gimp_edit_named_copy_visible(image, used)
+        used = pdb.gimp_edit_named_copy_visible(image, used)
     else:
-        pdb.gimp_edit_named_copy(drawable, used)
+        used = pdb.gimp_edit_named_copy(drawable, used)
+    if used:
+        _BufferIndex().push(used, source, layerpath)
 
 def _numbered_filename(path, digits=2):
     from itertools import count
@@ -600,6 +1228,102 @@ def _numbered_filename(path, digits=2):
     raise ValueError('You should never reach this line')
 
 
+class _FilenameAllocator(object):
+    """Hands out numbered filenames that don't exist yet, in the manner of _numbered_filename().
+
+    Each directory is listed (and created, if necessary) only once. From then on the allocator
+    keeps its own index of the names in use, and remembers where the search for a free number
+    stopped for each base name, so allocating doesn't cost any more stat calls.
+
+    Allocated names are reserved by exclusively creating an empty file, so another process
+    writing to the same directory can't be handed the same name.
+    """
+    def __init__(self, digits=2):
+        if digits < 1 or digits > 100:
+            raise ValueError('Invalid number of digits %r' % digits)
+        self.format = '-%0' + str(digits) + 'd'
+        # absolute directory path -> set of names in it
+        self.names = {}
+        # (absolute directory path, base, ext) -> lowest number that may be free
+        self.next = {}
+        # allocated path -> (key into self.next, number)
+        self.allocated = {}
+
+    def _names(self, directory):
+        import errno
+        names = self.names.get(directory)
+        if names is None:
+            try:
+                names = set(os.listdir(directory))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                os.makedirs(directory)
+                names = set()
+            self.names[directory] = names
+        return names
+
+    def allocate(self, path):
+        import errno
+        dirname, filename = os.path.split(path)
+        directory = os.path.abspath(dirname)
+        names = self._names(directory)
+        base, ext = _splitext(filename)
+        key = (directory, base, ext)
+        i = self.next.get(key, 0)
+        while True:
+            # arbitrary bailout at 16M items, as in _numbered_filename
+            if i >= 0xffffff:
+                raise ValueError('Reached bailout at %d without finding a free filename' % i)
+            thistry = filename if i == 0 else base + (self.format % i) + ext
+            if thistry not in names:
+                try:
+                    fd = os.open(os.path.join(directory, thistry), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    # created by someone else since we listed the directory
+                else:
+                    os.close(fd)
+                    names.add(thistry)
+                    self.next[key] = i + 1
+                    path = os.path.join(dirname, thistry)
+                    self.allocated[path] = (key, i)
+                    return path
+                names.add(thistry)
+            i += 1
+
+    def is_numbering(self, path, candidate):
+        """Whether candidate is path, or a numbered variant of it that allocate() could have returned."""
+        dirname, filename = os.path.split(path)
+        cdirname, cfilename = os.path.split(candidate)
+        if os.path.abspath(dirname) != os.path.abspath(cdirname):
+            return False
+        base, ext = _splitext(filename)
+        return re.match(re.escape(base) + '(-[0-9]{%d,})?' % (len(self.format % 0) - 1) + re.escape(ext) + '$',
+                        cfilename) is not None
+
+    def claim(self, path):
+        """Reserve path itself, whether or not it exists, so it can be overwritten."""
+        dirname, filename = os.path.split(path)
+        self._names(os.path.abspath(dirname)).add(filename)
+        return path
+
+    def release(self, path):
+        """Give back a name returned by allocate(), removing its reservation file (or whatever was written to it).
+
+        Claimed names are kept.
+        """
+        if path not in self.allocated:
+            return
+        key, i = self.allocated.pop(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self.names[key[0]].discard(os.path.basename(path))
+        self.next[key] = min(self.next[key], i)
+
 def _dashjoin(lhs, rhs):
     if not rhs:
         return lhs
@@ -607,6 +1331,128 @@ def _dashjoin(lhs, rhs):
         return rhs
     return '%s-%s' % (lhs.rstrip('-'), rhs.lstrip('-'))
 
+def _with_alpha(pixels, colormap=None):
+    """Return pixels with an alpha channel, expanded through colormap if one is given."""
+    import numpy as np
+    if colormap is not None:
+        cmap = np.frombuffer(colormap, dtype=np.uint8).reshape(-1, 3)
+        rgb = cmap[pixels[..., 0]]
+        pixels = np.dstack((rgb, pixels[..., 1])) if pixels.shape[2] == 2 else rgb
+    if pixels.shape[2] in (1, 3):
+        pixels = np.dstack((pixels, np.full(pixels.shape[:2], 255, dtype=np.uint8)))
+    return pixels
+
+def _autocrop(pixels):
+    """Crop away borders of pixels, as plug-in-autocrop would.
+
+    The border color is that of the top left pixel; if that is fully transparent, any fully
+    transparent pixel counts as border. Returns pixels unchanged if it is all border.
+    """
+    import numpy as np
+    border = pixels[0, 0]
+    if pixels.shape[2] in (2, 4) and border[-1] == 0:
+        content = pixels[..., -1] != 0
+    else:
+        content = (pixels != border).any(axis=2)
+    rows = np.flatnonzero(content.any(axis=1))
+    if not len(rows):
+        return pixels
+    cols = np.flatnonzero(content.any(axis=0))
+    return pixels[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+def _extract_clipping(image, drawable, visible=False, projection=None):
+    """Read the selected part of drawable, or of the image projection if visible is true, as Edit->Copy would.
+
+    Returns (pixels, colormap), or None if the selection doesn't intersect the source: pixels is a
+    (height, width, bpp) array, and colormap is None unless the source is indexed.
+    The pixels cover the selection bounds; unselected pixels are made transparent, and partially
+    selected ones partially transparent. Without a selection, the whole source is returned.
+    projection, an image-sized array with alpha, is used instead of the image projection if given.
+    """
+    import numpy as np
+    temporary = None
+    if visible:
+        if projection is None:
+            # GIMP 2.8 has no direct access to the projection, but this skips the buffer and image that copy+paste would create.
+            source = temporary = pdb.gimp_layer_new_from_visible(image, image, 'copynaut projection')
+        non_empty, x1, y1, x2, y2 = pdb.gimp_selection_bounds(image)
+        if not non_empty:
+            x1, y1, x2, y2 = 0, 0, image.width, image.height
+        non_empty = x2 > x1 and y2 > y1
+    else:
+        source = drawable
+        non_empty, x1, y1, w, h = pdb.gimp_drawable_mask_intersect(drawable)
+        x2, y2 = x1 + w, y1 + h
+    try:
+        if not non_empty:
+            return None
+        w, h = x2 - x1, y2 - y1
+        if visible and projection is not None:
+            pixels, colormap = projection[y1:y2, x1:x2], None
+            (ox, oy), has_alpha = (0, 0), True
+        else:
+            data = source.get_pixel_rgn(x1, y1, w, h, False, False)[x1:x2, y1:y2]
+            pixels = np.frombuffer(data, dtype=np.uint8).reshape(h, w, source.bpp)
+            colormap = image.colormap if source.is_indexed else None
+            ox, oy = source.offsets
+            has_alpha = source.has_alpha
+        if not pdb.gimp_selection_is_empty(image):
+            sx, sy = ox + x1, oy + y1
+            mask = image.selection.get_pixel_rgn(sx, sy, w, h, False, False)[sx:sx + w, sy:sy + h]
+            mask = np.frombuffer(mask, dtype=np.uint8).reshape(h, w, 1)
+            if has_alpha:
+                alpha = (pixels[..., -1:].astype(np.uint16) * mask + 127) // 255
+                pixels = np.concatenate((pixels[..., :-1], alpha.astype(np.uint8)), axis=2)
+            else:
+                pixels = np.concatenate((pixels, mask), axis=2)
+        return pixels, colormap
+    finally:
+        if temporary is not None:
+            pdb.gimp_item_delete(temporary)
+
+class _LayerCompositor(object):
+    """Composites single layers over an optional background layer in memory.
+
+    The result is what the image projection shows with only those layers visible, for layers
+    that supports() accepts: normal mode, no layer mask, not a layer group.
+    """
+    def __init__(self, image, background=None):
+        import numpy as np
+        self.image = image
+        channels = 2 if image.base_type == GRAY else 4
+        self.base = np.zeros((image.height, image.width, channels), dtype=np.float32)
+        if background is not None:
+            self._over(self.base, background)
+
+    @staticmethod
+    def supports(layer):
+        return layer.mode == NORMAL_MODE and layer.mask is None and not pdb.gimp_item_is_group(layer)
+
+    def _over(self, dest, layer):
+        import numpy as np
+        ox, oy = layer.offsets
+        x1, y1 = max(ox, 0), max(oy, 0)
+        x2, y2 = min(ox + layer.width, self.image.width), min(oy + layer.height, self.image.height)
+        if x2 <= x1 or y2 <= y1:
+            return
+        lx1, ly1, lx2, ly2 = x1 - ox, y1 - oy, x2 - ox, y2 - oy
+        data = layer.get_pixel_rgn(lx1, ly1, lx2 - lx1, ly2 - ly1, False, False)[lx1:lx2, ly1:ly2]
+        src = np.frombuffer(data, dtype=np.uint8).reshape(y2 - y1, x2 - x1, layer.bpp)
+        src = _with_alpha(src, self.image.colormap if layer.is_indexed else None).astype(np.float32) / 255
+        d = dest[y1:y2, x1:x2]
+        alpha = src[..., -1:] * (layer.opacity / 100.)
+        below = d[..., -1:] * (1 - alpha)
+        total = alpha + below
+        d[..., :-1] = np.where(total > 0, (src[..., :-1] * alpha + d[..., :-1] * below) / np.maximum(total, 1e-6), 0)
+        d[..., -1:] = total
+
+    def composite(self, layer):
+        """Return the image-sized uint8 projection of layer over the background."""
+        import numpy as np
+        out = self.base.copy()
+        self._over(out, layer)
+        return np.round(out * 255).astype(np.uint8)
+
 def _export(image, path):
     _, ext = _splitext(path)
     ext = ext.lower()
@@ -623,22 +1469,686 @@ def _export(image, path):
         pdb.file_webp_save(*params)
         return True
     elif ext in ('.jpg','.jpeg'):
-        params = params + + conf.export.jpeg_args
+        params = params + conf.export.jpeg_args
         pdb.file_jpeg_save(*params)
         return True
     return False
 
-def apply_src_tag(conf, path, image, drawable, vectors=None, nlayers=1):
-    # for now, we just tag mtime year (eg 2010) of src onto the extracted item
-    from subprocess import check_output, CalledProcessError, call
-    import os
-    import re
+def _png_filter(raw, bpp, block=256):
+    """Apply PNG scanline filters to raw, a (height, width * bpp) uint8 array.
+
+    Each row gets whichever of the five filter types minimizes the sum of absolute (signed)
+    differences, the heuristic libpng recommends. Returns a (height, 1 + width * bpp) array
+    with the filter type in the first column.
+    """
+    import numpy as np
+    h, rowbytes = raw.shape
+    out = np.empty((h, rowbytes + 1), dtype=np.uint8)
+    for y0 in range(0, h, block):
+        y1 = min(h, y0 + block)
+        a = raw[y0:y1].astype(np.int16)
+        up = np.zeros_like(a)
+        up[1:] = a[:-1]
+        if y0:
+            up[0] = raw[y0 - 1]
+        left = np.zeros_like(a)
+        left[:, bpp:] = a[:, :-bpp]
+        upleft = np.zeros_like(a)
+        upleft[:, bpp:] = up[:, :-bpp]
+        p = left + up - upleft
+        pa, pb, pc = abs(p - left), abs(p - up), abs(p - upleft)
+        paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+        candidates = (np.stack([a, a - left, a - up, a - (left + up) // 2, a - paeth]) & 0xff).astype(np.uint8)
+        cost = abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        choice = cost.argmin(axis=0)
+        out[y0:y1, 0] = choice
+        out[y0:y1, 1:] = candidates[choice, np.arange(y1 - y0)]
+    return out
+
+def _png_bytes(pixels, colormap=None, compression=9):
+    """Encode a (height, width, channels) uint8 array as PNG.
+
+    channels may be 1 (gray), 2 (gray + alpha), 3 (RGB) or 4 (RGBA).
+    If colormap (a string of packed RGB triplets) is given, pixels hold colormap indices,
+    with an optional alpha channel that is thresholded at 50%, as GIMP does for indexed images.
+    """
+    import numpy as np
+    import struct
+    import zlib
+    h, w, c = pixels.shape
+    trns = None
+    if colormap is not None:
+        ncolors = len(colormap) // 3
+        if c == 2:
+            transparent = pixels[..., 1] < 128
+            pixels = pixels[..., :1]
+            if transparent.any():
+                if ncolors < 256:
+                    pixels = np.where(transparent[..., None], ncolors, pixels).astype(np.uint8)
+                    colormap = colormap + '\0\0\0'
+                    trns = '\xff' * ncolors + '\0'
+                else:
+                    # no room for a transparent entry, so fall back to RGBA.
+                    cmap = np.frombuffer(colormap, dtype=np.uint8).reshape(-1, 3)
+                    alpha = np.where(transparent, 0, 255).astype(np.uint8)
+                    return _png_bytes(np.dstack((cmap[pixels[..., 0]], alpha)), None, compression)
+        color_type = 3
+        c = 1
+    else:
+        color_type = {1: 0, 2: 4, 3: 2, 4: 6}[c]
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    filtered = _png_filter(np.ascontiguousarray(pixels).reshape(h, w * c), c)
+    parts = ['\x89PNG\r\n\x1a\n',
+             chunk('IHDR', struct.pack('>IIBBBBB', w, h, 8, color_type, 0, 0, 0))]
+    if colormap is not None:
+        parts.append(chunk('PLTE', colormap))
+    if trns is not None:
+        parts.append(chunk('tRNS', trns))
+    parts.append(chunk('IDAT', zlib.compress(filtered.tostring(), compression)))
+    parts.append(chunk('IEND', ''))
+    return ''.join(parts)
+
+def _encode(job):
+    """Encode and write one EncodeJob. Runs in an encoder process.
+
+    Returns (path, number of bytes written, seconds taken).
+    """
     import time
+    start = time.time()
+    if job.ext == '.png':
+        data = _png_bytes(job.pixels, job.colormap)
+        with open(job.path, 'wb') as f:
+            f.write(data)
+    else:
+        _pil_save(job, job.path)
+    return job.path, os.path.getsize(job.path), time.time() - start
+
+def _encode_member(job):
+    """Encode one EncodeJob into memory, for an archive member named job.path. Runs in an encoder process.
+
+    Returns (path, number of bytes, seconds taken, encoded data).
+    """
+    import time
+    from io import BytesIO
+    start = time.time()
+    if job.ext == '.png':
+        data = _png_bytes(job.pixels, job.colormap)
+    else:
+        f = BytesIO()
+        _pil_save(job, f)
+        data = f.getvalue()
+    return job.path, len(data), time.time() - start, data
+
+def _pil_save(job, f):
+    """Encode the .webp or .jpg EncodeJob job into f, a path or file object."""
+    import numpy as np
+    from PIL import Image
+    pixels = job.pixels
+    if job.colormap is not None:
+        cmap = np.frombuffer(job.colormap, dtype=np.uint8).reshape(-1, 3)
+        rgb = cmap[pixels[..., 0]]
+        pixels = np.dstack((rgb, pixels[..., 1])) if pixels.shape[2] == 2 else rgb
+    mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[pixels.shape[2]]
+    im = Image.fromarray(pixels if pixels.shape[2] > 1 else pixels[..., 0], mode)
+    if job.ext == '.webp':
+        if mode in ('L', 'LA'):
+            im = im.convert('RGBA' if mode == 'LA' else 'RGB')
+        im.save(f, 'WEBP', quality=job.webp_args[0])
+    else:
+        # jpeg has no alpha
+        im = im.convert('L' if mode in ('L', 'LA') else 'RGB')
+        im.save(f, 'JPEG', quality=int(job.jpeg_args[0] * 100))
+
+def _can_encode(ext):
+    """Whether files with extension ext can be encoded outside of GIMP."""
     try:
-        tmsu = check_output(['which','tmsu'])
-    except CalledProcessError:
-        pdb.gimp_message('Skipping tmsu tagging for %r, tmsu doesn\'t appear to be installed.' % path)
-        return
+        import numpy
+        if ext in ('.webp', '.jpg', '.jpeg'):
+            import PIL.Image
+    except ImportError:
+        return False
+    return ext in ('.png', '.webp', '.jpg', '.jpeg')
+
+class _Encoder(object):
+    """Encodes and writes exported clippings, in a pool of worker processes when configured to.
+
+    At most queue_size clippings are waiting to be encoded at any time; submitting another one
+    first waits for the oldest to complete. Completion callbacks run in the GIMP plug-in process
+    (so they may use the PDB), in submission order.
+    The pool is only started once a second clipping is submitted; a lone clipping is encoded
+    in the plug-in process when the encoder is drained.
+    """
+    def __init__(self, processes, queue_size):
+        import multiprocessing
+        from collections import deque
+        if processes <= 0:
+            processes = multiprocessing.cpu_count()
+        # worker processes must be forked from this one; elsewhere they'd rerun the plug-in on import.
+        if os.name != 'posix':
+            processes = 1
+        self.processes = processes
+        self.queue_size = queue_size
+        self.pool = None
+        # (job, encode, on_done, on_error) submitted before the pool was started
+        self.deferred = None
+        self.pending = deque()
+        self.written = 0
+        self.failed = []
+        self.skipped = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+
+    def submit(self, job, on_done=None, on_error=None, encode=None):
+        """Encode job; then call on_done(path) if it was written, or on_error(path, exception).
+
+        encode(job) does the work, _encode by default. It returns (path, number of bytes, seconds taken),
+        optionally followed by more results, which are passed on to on_done after path.
+        """
+        encode = encode or _encode
+        if self.processes == 1:
+            self._encode_here(job, encode, on_done, on_error)
+            return
+        if self.pool is None:
+            if self.deferred is None:
+                self.deferred = (job, encode, on_done, on_error)
+                return
+            from multiprocessing import Pool
+            self.pool = Pool(self.processes)
+            self._dispatch(*self.deferred)
+            self.deferred = None
+        self._dispatch(job, encode, on_done, on_error)
+
+    def _dispatch(self, job, encode, on_done, on_error):
+        while len(self.pending) >= self.queue_size:
+            self._collect()
+        self.pending.append((job.path, self.pool.apply_async(encode, (job,)), on_done, on_error))
+
+    def _encode_here(self, job, encode, on_done, on_error):
+        try:
+            result = encode(job)
+        except Exception as e:
+            self._failed(job.path, e, on_error)
+        else:
+            self._done(result, on_done)
+
+    def record(self, path):
+        """Count a file that was written some other way (eg. by a GIMP file plug-in)."""
+        self.written += 1
+        self.nbytes += os.path.getsize(path)
+
+    def skip(self, path):
+        """Count a clipping that didn't need writing, because path already holds it."""
+        self.skipped += 1
+
+    def _collect(self):
+        path, result, on_done, on_error = self.pending.popleft()
+        try:
+            result = result.get()
+        except Exception as e:
+            self._failed(path, e, on_error)
+        else:
+            self._done(result, on_done)
+
+    def _done(self, result, on_done):
+        path, nbytes, seconds = result[:3]
+        self.written += 1
+        self.nbytes += nbytes
+        self.seconds += seconds
+        if on_done:
+            on_done(path, *result[3:])
+
+    def _failed(self, path, exception, on_error):
+        self.failed.append((path, exception))
+        if on_error:
+            on_error(path, exception)
+
+    def drain(self):
+        """Wait for all pending clippings to be written."""
+        if self.deferred is not None:
+            deferred, self.deferred = self.deferred, None
+            self._encode_here(*deferred)
+        while self.pending:
+            self._collect()
+
+    def finish(self):
+        """Wait for all pending clippings to be written, and return an EncodeSummary."""
+        self.drain()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return EncodeSummary(self.written, len(self.failed), self.skipped, self.nbytes, self.seconds)
+
+class _Journal(object):
+    """Append-only record of the clippings exported from one source image, so an interrupted
+    batch can be resumed.
+
+    Each line is a JSON object with the fields of a JournalEntry; the last line for an item wins.
+    Status is 'started' when a clipping is queued, then 'done' or 'failed'.
+    The journal lives in the GIMP profile, named after a hash of the source image's real path.
+    """
+    def __init__(self, filename):
+        import json
+        from hashlib import sha1
+        self.path = os.path.join(gimp.directory, 'copynaut', 'journal',
+                                 sha1(os.path.realpath(filename)).hexdigest() + '.jsonl')
+        # item -> JournalEntry
+        self.entries = {}
+        self.file = None
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    entry = JournalEntry(*[entry[k].encode('utf-8') for k in JournalEntry._fields])
+                except (ValueError, KeyError, AttributeError):
+                    # most likely a line cut short by a crash
+                    continue
+                self.entries[entry.item] = entry
+
+    def lookup(self, item):
+        """Return the last JournalEntry recorded for item, or None."""
+        return self.entries.get(item)
+
+    def record(self, item, hash, path, status):
+        import json
+        entry = JournalEntry(item, hash, os.path.abspath(path), status)
+        if self.file is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps(entry._asdict()) + '\n')
+        # so that the entry survives the plug-in crashing
+        self.file.flush()
+        self.entries[item] = entry
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def _journal_item(drawable, vectors, visible, path):
+    """Identify a clipping across runs: by source item tattoos, and the (unnumbered) path it exports to."""
+    return '%d:%s:%d:%s' % (pdb.gimp_item_get_tattoo(drawable),
+                            pdb.gimp_item_get_tattoo(vectors) if vectors else '',
+                            1 if visible else 0, os.path.abspath(path))
+
+def _region_hash(pixels, colormap=None):
+    """Return a hex digest of a clipping's pixels (and colormap)."""
+    import numpy as np
+    from hashlib import sha1
+    h = sha1(repr(pixels.shape))
+    h.update(np.ascontiguousarray(pixels).tostring())
+    if colormap is not None:
+        h.update(colormap)
+    return h.hexdigest()
+
+class _ExportCache(object):
+    """Maps the content of exported clippings to the files they were written to, across batches and images.
+
+    Keys are hashes of the pixels and the encoding settings (see _export_cache_key). Entries are
+    appended to copynaut/export-cache.jsonl in the GIMP profile when the batch closes, and only
+    trusted while the file they name still has the size and mtime it was written with.
+
+    Several GIMP processes (such as copynaut_batch.py's workers) may share the file, so appending
+    and compacting it are done holding export-cache.jsonl.lock.
+    """
+    def __init__(self):
+        self.path = os.path.join(gimp.directory, 'copynaut', 'export-cache.jsonl')
+        # key -> (path, size, mtime)
+        self.entries = {}
+        # keys added in this batch, not yet appended to the file
+        self.pending = []
+        lines = self._read()
+        if lines > 2 * len(self.entries) + 64:
+            # mostly superseded entries; rewrite it with only the current ones.
+            self._compact()
+
+    def _read(self):
+        """Read the file's entries into self.entries, and return its number of lines."""
+        import json
+        lines = 0
+        try:
+            f = open(self.path)
+        except IOError:
+            return lines
+        with f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry['key'].encode('utf-8')] = (entry['path'].encode('utf-8'), entry['size'], entry['mtime'])
+                except (ValueError, KeyError, AttributeError):
+                    continue
+        return lines
+
+    @contextmanager
+    def _lock(self, wait=True):
+        """Hold the lock file, and yield True.
+
+        Without wait, if another process holds the lock, this yields False instead.
+        Without flock (ie. not on POSIX), waiting always succeeds, and not waiting never does.
+        """
+        if os.name != 'posix':
+            yield wait
+            return
+        import fcntl
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + '.lock', 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _compact(self):
+        import json
+        with self._lock(wait=False) as locked:
+            if not locked:
+                # someone else is using it; leave compacting for another time.
+                return
+            # pick up whatever was appended since we read it
+            self._read()
+            temp = '%s.%d.new' % (self.path, os.getpid())
+            with open(temp, 'w') as f:
+                for key, (path, size, mtime) in self.entries.items():
+                    if self._valid(path, size, mtime):
+                        f.write(json.dumps(dict(key=key, path=path, size=size, mtime=mtime)) + '\n')
+            os.rename(temp, self.path)
+
+    @staticmethod
+    def _valid(path, size, mtime):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_size == size and st.st_mtime == mtime
+
+    def lookup(self, key):
+        """Return the absolute path of the file key was exported to, if it is still there unmodified."""
+        entry = self.entries.get(key)
+        if entry is None or not self._valid(*entry):
+            return None
+        return entry[0]
+
+    def add(self, key, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        self.entries[key] = (path, st.st_size, st.st_mtime)
+        self.pending.append(key)
+
+    def close(self):
+        """Append the entries added in this batch to the file."""
+        import json
+        if not self.pending:
+            return
+        lines = []
+        for key in self.pending:
+            path, size, mtime = self.entries[key]
+            lines.append(json.dumps(dict(key=key, path=path, size=size, mtime=mtime)) + '\n')
+        self.pending = []
+        with self._lock():
+            with open(self.path, 'a') as f:
+                f.write(''.join(lines))
+
+def _export_cache_key(conf, ext, digest):
+    """Return the _ExportCache key for a clipping with _region_hash digest, exported as ext with conf's settings."""
+    from hashlib import sha1
+    if ext == '.webp':
+        settings = conf.export.webp_args
+    elif ext in ('.jpg', '.jpeg'):
+        settings = conf.export.jpeg_args
+    else:
+        settings = ()
+    return sha1('%s %s %r' % (digest, ext, settings)).hexdigest()
+
+def _link_or_copy(source, dest):
+    """Make dest a hard link to source, or a copy of it where hard links aren't possible."""
+    import shutil
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except (OSError, AttributeError):
+        # different filesystem, or no os.link at all (Windows, Python 2)
+        shutil.copyfile(source, dest)
+
+def _shelf_pack(sizes, padding=1):
+    """Place rectangles of the given (width, height) sizes in rows ('shelves'), tallest first.
+
+    The shelves are about as wide as a square holding all of the rectangles would be.
+    Returns (total width, total height, [(x, y) of each rectangle, in the order of sizes]).
+    """
+    import math
+    area = sum((w + padding) * (h + padding) for w, h in sizes)
+    limit = max([int(math.ceil(math.sqrt(area)))] + [w for w, h in sizes])
+    positions = [None] * len(sizes)
+    x = y = shelf = width = 0
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0])):
+        w, h = sizes[i]
+        if x and x + w > limit:
+            x, y, shelf = 0, y + shelf + padding, 0
+        positions[i] = (x, y)
+        width = max(width, x + w)
+        x += w + padding
+        shelf = max(shelf, h)
+    return width, y + shelf, positions
+
+class _PackedTarget(object):
+    """Base for export targets that put all the clippings of a batch into a single file.
+
+    The file is named after the source image, and placed in the directory of the first clipping.
+    Clippings are known by the file name they would otherwise have been exported to,
+    numbered like _FilenameAllocator does if they clash.
+    """
+    suffix = ''
+
+    def __init__(self, batch, conf):
+        self.batch = batch
+        self.conf = conf
+        self.path = None
+        self.ext = None
+        self.names = set()
+        self.count = 0
+
+    def _container(self, path, ext):
+        """Reserve the name of the single file, next to path."""
+        basename = 'Untitled'
+        if self.batch.image.filename:
+            basename = _splitext(os.path.basename(self.batch.image.filename))[0]
+        self.ext = ext
+        return self.batch.filenames.allocate(os.path.join(os.path.dirname(path), basename + self.suffix + ext))
+
+    def _member_name(self, path):
+        name = os.path.basename(path)
+        base, ext = _splitext(name)
+        i = 0
+        while name in self.names:
+            i += 1
+            name = base + (self.batch.filenames.format % i) + ext
+        self.names.add(name)
+        self.count += 1
+        return name
+
+class _AtlasTarget(_PackedTarget):
+    """Packs the clippings into a sprite sheet, with a JSON sidecar (named like the sheet) of their rectangles:
+
+        {"image": sheet file name, "size": [width, height],
+         "frames": {clipping name: {"x": x, "y": y, "w": width, "h": height}, ...}}
+    """
+    suffix = '-atlas'
+
+    def __init__(self, batch, conf):
+        _PackedTarget.__init__(self, batch, conf)
+        self.sprites = []
+
+    def add(self, path, ext, pixels, colormap):
+        if self.path is None:
+            self.path = self._container(path, ext)
+        pixels = _with_alpha(pixels, colormap)
+        if pixels.shape[2] == 2:
+            pixels = pixels[..., [0, 0, 0, 1]]
+        self.sprites.append((self._member_name(path), pixels))
+
+    def close(self):
+        import json
+        import numpy as np
+        if self.path is None:
+            return
+        width, height, positions = _shelf_pack([(p.shape[1], p.shape[0]) for name, p in self.sprites])
+        sheet = np.zeros((height, width, 4), dtype=np.uint8)
+        frames = {}
+        for (name, pixels), (x, y) in zip(self.sprites, positions):
+            h, w = pixels.shape[:2]
+            sheet[y:y + h, x:x + w] = pixels
+            frames[name] = dict(x=x, y=y, w=w, h=h)
+        colormap = None
+        image = self.batch.image
+        if self.ext == '.png' and image.base_type == INDEXED:
+            indices = _indexize(sheet, image.colormap)
+            if indices is not None:
+                sheet, colormap = indices, image.colormap
+        # named after the sheet, unless that name is taken
+        sidecar = self.batch.filenames.allocate(_splitext(self.path)[0] + '.json')
+        with open(sidecar, 'w') as f:
+            json.dump(dict(image=os.path.basename(self.path), size=[width, height], frames=frames),
+                      f, indent=1, sort_keys=True)
+        self.batch.encoder.submit(EncodeJob(self.path, self.ext, sheet, colormap,
+                                            self.conf.export.webp_args, self.conf.export.jpeg_args))
+        pdb.gimp_message('Packed %d clippings into %s.' % (self.count, self.path))
+
+class _ArchiveTarget(_PackedTarget):
+    """Streams the clippings, encoded by the batch encoder, into one uncompressed tar or zip archive."""
+    suffix = '-clippings'
+
+    def __init__(self, batch, conf, kind):
+        _PackedTarget.__init__(self, batch, conf)
+        self.kind = kind
+        self.archive = None
+
+    def add(self, path, ext, pixels, colormap):
+        import tarfile, zipfile
+        if self.path is None:
+            self.path = self._container(path, '.' + self.kind)
+            if self.kind == 'tar':
+                self.archive = tarfile.open(self.path, 'w')
+            else:
+                self.archive = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        job = EncodeJob(self._member_name(path), ext, pixels, colormap, self.conf.export.webp_args,
+                        self.conf.export.jpeg_args)
+        def failed(name, exception):
+            pdb.gimp_message('Exporting %s to %s failed: %s' % (name, self.path, exception))
+        self.batch.encoder.submit(job, self._write, failed, _encode_member)
+
+    def _write(self, name, data):
+        import time, tarfile, zipfile
+        from io import BytesIO
+        if self.kind == 'tar':
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, BytesIO(data))
+        else:
+            self.archive.writestr(zipfile.ZipInfo(name, time.localtime()[:6]), data)
+
+    def close(self):
+        if self.archive is None:
+            return
+        # members are written as they are encoded
+        self.batch.encoder.drain()
+        self.archive.close()
+        pdb.gimp_message('Packed %d clippings into %s.' % (self.count, self.path))
+
+def _packed_target(batch, conf):
+    """Return the _PackedTarget for conf's export target, or None to export to separate files."""
+    if conf.export.target == 'atlas':
+        return _AtlasTarget(batch, conf)
+    elif conf.export.target in ('tar', 'zip'):
+        return _ArchiveTarget(batch, conf, conf.export.target)
+    return None
+
+class _Tagger(object):
+    """Tags exported files with TMSU, in bulk.
+
+    tmsu is located once, and the 'general tags' of each export directory and the mtime of each
+    source file are looked up once. Tagging is queued, and flush() tags all the files sharing a
+    directory and tag set with a single 'tmsu tag' call.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.executable = None
+        self.dirtags = {}
+        self.mtimes = {}
+        # (directory, tags) -> [paths]
+        self.queue = {}
+
+    def _tmsu(self):
+        if self.executable is None:
+            from distutils.spawn import find_executable
+            self.executable = find_executable(self.command) or ''
+            if not self.executable:
+                pdb.gimp_message('Skipping tmsu tagging, %s doesn\'t appear to be installed.' % self.command)
+        return self.executable
+
+    def _general_tags(self, dirname):
+        """Return any 'general tags' that apply to all extractions in dirname."""
+        from subprocess import check_output
+        tags = self.dirtags.get(dirname)
+        if tags is None:
+            tags = check_output([self._tmsu(), 'tags', '--', os.path.realpath(dirname)], cwd=dirname).decode('utf8').strip()
+            tags = tags.split(': ', 1)
+            if len(tags) == 1:
+                tags = []
+            else:
+                # XXX implement support for \-escaping, eg. '\ '
+                tags = tags[-1].split(' ')
+            if len(tags) == 1 and tags[0] == '':
+                tags = []
+            self.dirtags[dirname] = tags
+        return tags
+
+    def _mtime_year(self, source):
+        import time
+        year = self.mtimes.get(source)
+        if year is None:
+            year = self.mtimes[source] = time.localtime(os.stat(source).st_mtime).tm_year
+        return year
+
+    def add(self, path, source):
+        """Queue path to be tagged with information about source."""
+        if not self._tmsu():
+            return
+        path = os.path.abspath(path)
+        dirname = os.path.dirname(path)
+        # don't I have a thing for tmsu-escaping values lying around somewhere? lhtag?
+        # a quick fix should just escape any spaces or equals..
+        tags = tuple(self._general_tags(dirname)) + (str(self._mtime_year(source)),)
+        self.queue.setdefault((dirname, tags), []).append(path)
+
+    def flush(self):
+        from subprocess import check_output, CalledProcessError, STDOUT
+        queue, self.queue = self.queue, {}
+        for (dirname, tags), paths in sorted(queue.items()):
+            try:
+                check_output([self._tmsu(), '-v', 'tag', '--tags=' + ' '.join(tags), '--'] + paths,
+                             cwd=dirname, stderr=STDOUT)
+            except CalledProcessError as e:
+                pdb.gimp_message('Tagging %d files in %s failed: %s' % (len(paths), dirname, e.output))
+
+def apply_src_tag(conf, path, image, drawable, vectors=None, nlayers=1):
+    # for now, we just tag mtime year (eg 2010) of src onto the extracted item
 #    try:
 #        refcodes = check_output(['which','refcodes'])
 #    except CalledProcessError:
@@ -650,24 +2160,39 @@ def apply_src_tag(conf, path, image, drawable, vectors=None, nlayers=1):
 #    refcode = check_output(['refcodes', '-s', '--', image.filename]).rstrip()
 #    if len(refcode) < 4:
 #        pdb.gimp_message('Skipping tmsu tagging for %r, refcode %r returned for %r looks invalid.' % (path, refcode, image.filename))
-    # get any 'general tags' that apply to all extractions in this directory.
-    dirname = os.path.dirname(path)
-    tags = check_output(['tmsu', 'tags', '--', os.path.realpath(dirname)], cwd=dirname).decode('utf8').strip()
-    pdb.gimp_message('raw tag output = %r' % (tags,))
-    tags = tags.split(': ', 1)
-    if len(tags) == 1:
-        tags = []
-    else:
-        # XXX implement support for \-escaping, eg. '\ '
-        tags = tags[-1].split(' ')
-    if len(tags) == 1 and tags[0] == '':
-        tags = []
-    mtyear = time.localtime(os.stat(image.filename).st_mtime).tm_year
-    content = str(mtyear)
-    # don't I have a thing for tmsu-escaping values lying around somewhere? lhtag?
-    # a quick fix should just escape any spaces or equals..
-    o = check_output(['tmsu', '-v','tag', '--', path, content] + tags, cwd=dirname)
+    # tags are applied when the batch ends
+    with export_batch(image) as batch:
+        batch.tagger.add(path, image.filename)
+
 
+def _indexize(pixels, colormap):
+    """Map RGB(A) pixels exactly onto colormap (a string of packed RGB triplets).
+
+    Returns a (height, width, 1 or 2) array of colormap indices (plus the original alpha),
+    or None if some pixel that isn't mostly transparent has a color that isn't in the colormap.
+    If a color occurs in the colormap more than once, the lowest index is used.
+    """
+    import numpy as np
+    cmap = np.frombuffer(colormap, dtype=np.uint8).reshape(-1, 3).astype(np.uint32)
+    keys = (cmap[:, 0] << 16) | (cmap[:, 1] << 8) | cmap[:, 2]
+    if len(keys) == 0:
+        return None
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    rgb = pixels[..., :3].astype(np.uint32)
+    packed = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+    pos = np.minimum(np.searchsorted(sorted_keys, packed), len(keys) - 1)
+    found = sorted_keys[pos] == packed
+    has_alpha = pixels.shape[2] == 4
+    if has_alpha:
+        # these will be written as transparent, whatever their color
+        found |= pixels[..., 3] < 128
+    if not found.all():
+        return None
+    indices = order[pos].astype(np.uint8)
+    if has_alpha:
+        return np.dstack((indices, pixels[..., 3]))
+    return indices[..., None]
 
 @contextmanager
 def indexed_handler(image):
@@ -690,9 +2215,11 @@ def indexed_handler(image):
             i += 1
     else:
         p = None
-    yield p
-    if p:
-        pdb.gimp_palette_delete(p)
+    try:
+        yield p
+    finally:
+        if p:
+            pdb.gimp_palette_delete(p)
 
     # XXX in GIMP 2.9, non-binary alpha on an indexed image is possible and should be produced.
 
@@ -707,91 +2234,140 @@ def apply_palette(image, palette):
         return
     pdb.gimp_image_convert_indexed(image, NO_DITHER, CUSTOM_PALETTE, -1, 0, 0, palette)
 
-def colortoalpha_borders(image, drawable, radius):
-    # depends on python-fu-selection-from-path (sel2path plugin)
-    # algorithm is:
-    #
-    # * save drawable type
-    # * expand 1px on every border
-    # * convert to rgb
-    # * load drawable mask -> selection
-    # * invert
-    # * grow N
-    # * smooth it using python-fu-selection-from-path (if image type wasn't indexed)
-    # * call color2alpha
-    # * crop +1,+1.. -1,-1
-    # * restore drawable type
-    #
-    if radius == 0:
-        return
+def _dilate(values, radius):
+    """Grayscale dilation of a 2d array by an (approximately circular) radius.
+
+    Alternates 4- and 8-connected steps, which gives an octagon, like GIMP's Select->Grow.
+    """
+    import numpy as np
+    for i in range(radius):
+        p = np.pad(values, 1, 'edge')
+        neighbours = [p[1:-1, 1:-1], p[:-2, 1:-1], p[2:, 1:-1], p[1:-1, :-2], p[1:-1, 2:]]
+        if i % 2:
+            neighbours.extend([p[:-2, :-2], p[:-2, 2:], p[2:, :-2], p[2:, 2:]])
+        values = np.maximum.reduce(neighbours)
+    return values
+
+def _colortoalpha_contour(pixels, radius, mask=None):
+    """Remove white from the pixels within radius of the transparent area, as plug-in-colortoalpha would.
+
+    pixels is a (height, width, 2 or 4) array; the area outside of it counts as transparent.
+    If mask (a (height, width) uint8 array) is given, it is used instead of the band around the
+    transparent area, weighting the effect like a selection mask would; radius < 0 without a mask
+    covers all pixels.
+    Returns a new array.
+    """
+    import numpy as np
+    if mask is None and radius < 0:
+        mask = np.full(pixels.shape[:2], 255, dtype=np.uint8)
+    elif mask is None:
+        outside = np.pad(255 - pixels[..., -1], 1, 'constant', constant_values=255)
+        mask = _dilate(outside, radius)[1:-1, 1:-1]
+    pick = mask > 0
+    src = pixels[pick].astype(np.float64) / 255.
+    color, alpha = src[:, :-1], src[:, -1]
+    # for each channel, how far it is from white; the largest of these becomes the alpha
+    # that just suffices to produce the color when composited over white.
+    factor = (1. - color).max(axis=1)
+    opaque = factor > 0.0001
+    color = np.where(opaque[:, None], (color - 1.) / np.where(opaque, factor, 1.)[:, None] + 1., color)
+    removed = np.column_stack((color, alpha * factor))
+    weight = mask[pick][:, None] / 255.
+    result = pixels.copy()
+    result[pick] = np.round((src * (1. - weight) + removed * weight) * 255.).astype(np.uint8)
+    return result
+
+def _colortoalpha_borders_pdb(image, drawable, radius):
+    # fallback for when NumPy isn't available: the same band, computed with GIMP selection operations.
+    # plug-in-colortoalpha only handles RGB*, so grayscale images are converted to RGB and back.
     itype = image.base_type
     ifunc = pdb.gimp_image_convert_grayscale
     pdb.gimp_image_undo_group_start(image)
     if itype in (RGB, INDEXED):
         ifunc = lambda v:v
         if itype == INDEXED:
+            # XXX un-indexes images.
             pdb.gimp_image_convert_rgb(image)
     else:
-        # XXX un-indexes images.
         pdb.gimp_image_convert_rgb(image)
-
     if radius > -1:
         pdb.gimp_image_resize(image, image.width + 2, image.height + 2, 1, 1)
         for l in image.layers:
             pdb.gimp_layer_resize_to_image_size(l)
-
         pdb.gimp_selection_all(image)
-        pdb.gimp_image_select_item(image, CHANNEL_OP_SUBTRACT, image.layers[0])
+        pdb.gimp_image_select_item(image, CHANNEL_OP_SUBTRACT, drawable)
         pdb.gimp_selection_grow(image, radius)
-        pdb.python_fu_selection_to_path(image, image.layers[0], 1, 1.0, True, 0.2, 10, 1, True, False, 0.0)
-
-    pdb.plug_in_colortoalpha(image, drawable or image.layers[0], (255,255,255))
-
+    pdb.plug_in_colortoalpha(image, drawable, (255,255,255))
     if radius > -1:
         pdb.gimp_image_resize(image, image.width - 2, image.height - 2, -1, -1)
         for l in image.layers:
             pdb.gimp_layer_resize_to_image_size(l)
-
     ifunc(image)
     pdb.gimp_image_undo_group_end(image)
 
+def colortoalpha_borders(image, drawable, radius):
+    # Applies color to alpha (white), within a band of the given radius around the transparent area
+    # of the drawable (radius < 0: within the current selection instead).
+    #
+    # The band is computed from the alpha channel in-process, so no image resizing,
+    # mode conversion or potrace tracing is needed.
+    if radius == 0:
+        return
+    drawable = drawable or image.layers[0]
+    try:
+        import numpy as np
+    except ImportError:
+        return _colortoalpha_borders_pdb(image, drawable, radius)
+    pdb.gimp_image_undo_group_start(image)
+    if image.base_type == INDEXED:
+        # XXX un-indexes images.
+        pdb.gimp_image_convert_rgb(image)
+    if not drawable.has_alpha:
+        pdb.gimp_layer_add_alpha(drawable)
+    w, h, bpp = drawable.width, drawable.height, drawable.bpp
+    data = drawable.get_pixel_rgn(0, 0, w, h, False, False)[0:w, 0:h]
+    pixels = np.frombuffer(data, dtype=np.uint8).reshape(h, w, bpp)
+    mask = None
+    if radius < 0:
+        mask = np.full((h, w), 255, dtype=np.uint8)
+        if not pdb.gimp_selection_is_empty(image):
+            # the selection only covers the image; the rest of the drawable is unselected
+            mask[:] = 0
+            ox, oy = drawable.offsets
+            x1, y1 = max(ox, 0), max(oy, 0)
+            x2, y2 = min(ox + w, image.width), min(oy + h, image.height)
+            if x2 > x1 and y2 > y1:
+                sel = image.selection.get_pixel_rgn(x1, y1, x2 - x1, y2 - y1, False, False)[x1:x2, y1:y2]
+                mask[y1 - oy:y2 - oy, x1 - ox:x2 - ox] = np.frombuffer(sel, dtype=np.uint8).reshape(y2 - y1, x2 - x1)
+    result = _colortoalpha_contour(pixels, radius, mask)
+    dest = drawable.get_pixel_rgn(0, 0, w, h, True, True)
+    dest[0:w, 0:h] = result.tostring()
+    drawable.flush()
+    drawable.merge_shadow(True)
+    drawable.update(0, 0, w, h)
+    pdb.gimp_image_undo_group_end(image)
+
 def exportn(image, drawable, suffix, visible=False, autocrop=False, tagsource=True, presuffix='', colortoalpha=1, vectors=None):
-    # XXX indexed input should produce indexed output
     # xxx implement tagsource
     if not drawable:
         drawable = image.active_drawable
     if not image.filename:
         pdb.gimp_message('Image must be saved on disk before exporting clippings.')
         return
-    conf = _load_config(image.filename)
-    nlayers = len(image.layers)
-    if visible:
-        nlayers = 1
+    with export_batch(image) as batch:
+        _exportn(batch, image, drawable, suffix, visible, autocrop, tagsource, presuffix, colortoalpha, vectors)
+
+def _export_path(conf, image, drawable, suffix, presuffix, nlayers, bounds=None):
+    """Return (path, lowercased extension) to export a clipping of drawable to, before numbering.
+
+    bounds overrides the clipping area used for template variables (see _expand_template).
+    """
     # XXX actually support override properly via an argument
     dest_override = ''
     dest_override = dest_override if dest_override.rstrip() != '' else ''
-    dest = _expand_template(image, drawable, None, dest_override or conf.export.name_template, nlayers)
+    dest = _expand_template(image, drawable, None, dest_override or conf.export.name_template, nlayers, bounds)
     dest = _apply_regexp_substitutions(dest, conf.export.name_edits)
     destbase, ext = _splitext(dest)
-
-    if visible:
-        bname = pdb.gimp_edit_named_copy_visible(image, '_' + dest)
-    else:
-        bname = pdb.gimp_edit_named_copy(drawable, '_' + dest)
-
-    # paste as new image (This doesn't automatically create a view, thankfully)
-    with indexed_handler(image) as ipalette:
-        newimg = pdb.gimp_edit_named_paste_as_new(bname)
-        if ipalette:
-            pdb.gimp_message('indexizing..')
-            if ext.lower() != '.png' and dest != '.png':
-                pdb.gimp_message('Only png format is currently supported for indexed export, falling back to non-indexed for %r.' % bname)
-            else:
-                apply_palette(newimg, ipalette)
-        if colortoalpha != 0:
-            colortoalpha_borders(newimg, newimg.layers[0], colortoalpha)
-        if autocrop:
-            pdb.plug_in_autocrop(newimg, newimg.layers[0])
     # XXX perform extra processing -- border or flattening
     #
     # The following code puts parts together as follows:
@@ -800,7 +2376,7 @@ def exportn(image, drawable, suffix, visible=False, autocrop=False, tagsource=Tr
     # to determine the final export path.
     #
     suffix = presuffix + suffix
-    suffix = _expand_template(image, drawable, None, suffix, nlayers)
+    suffix = _expand_template(image, drawable, None, suffix, nlayers, bounds)
     suffix = _apply_regexp_substitutions(suffix, conf.export.name_edits)
 
     if destbase.startswith('.'):
@@ -820,26 +2396,180 @@ def exportn(image, drawable, suffix, visible=False, autocrop=False, tagsource=Tr
     if suffix:
         path = _dashjoin(path, suffix)
     path = path + ext
-    pathdir = os.path.dirname(path)
-    if not os.path.exists(pathdir):
-        os.makedirs(pathdir)
-    # get a filename that doesn't already exist on disk
-    path = _numbered_filename(path)
-    if os.path.exists(path):
-        # now we're using _numbered_filename, this branch should only be entered if there is a race condition
-        # (the output file didn't exist when _numbered_filename() ran, but has been created in the meantime)
-        pdb.gimp_message('Won\'t overwrite existing image %s' % path)
-        pdb.gimp_image_delete(newimg)
-        pdb.gimp_buffer_delete(bname)
+    return path, ext.lower()
+
+def _submit_export(batch, conf, path, ext, pixels, colormap, on_written=None, on_failed=None, on_started=None,
+                   reuse=None, digest=None):
+    """Reserve a free filename based on path (or the path reuse, overwriting it), and queue pixels to be encoded into it.
+
+    If the same pixels were exported with the same settings before, nothing is encoded: when the earlier
+    file is reuse, or (without reuse) path or a numbered variant of it, the clipping is skipped;
+    otherwise the earlier file is hard-linked (or copied) to the new name.
+    on_started(path) is called once a name is reserved, on_written(path) once the file is in place,
+    on_failed(path) if writing it failed. digest is the _region_hash() of pixels and colormap, if known.
+
+    If the batch packs clippings into a single file, pixels just go there under path's name.
+    """
+    if batch.target is not None:
+        batch.target.add(path, ext, pixels, colormap)
+        return
+    key = _export_cache_key(conf, ext, digest or _region_hash(pixels, colormap))
+    cached = batch.cache.lookup(key)
+    if cached is not None and (cached == reuse if reuse else batch.filenames.is_numbering(path, cached)):
+        batch.encoder.skip(cached)
+        if on_written:
+            on_written(cached)
+        return
+    path = batch.filenames.claim(reuse) if reuse else batch.filenames.allocate(path)
+    if on_started:
+        on_started(path)
+    if cached is not None:
+        try:
+            _link_or_copy(cached, path)
+        except (IOError, OSError):
+            pass
+        else:
+            batch.encoder.record(path)
+            if on_written:
+                on_written(path)
+            return
+    if reuse and os.path.exists(path):
+        # it may be hard-linked to another export, which mustn't change along with it
+        os.remove(path)
+    def written(path):
+        batch.cache.add(key, path)
+        if on_written:
+            on_written(path)
+    def failed(path, exception):
+        pdb.gimp_message('Exporting %s failed: %s' % (path, exception))
+        batch.filenames.release(path)
+        if on_failed:
+            on_failed(path)
+    try:
+        batch.encoder.submit(EncodeJob(path, ext, pixels, colormap, conf.export.webp_args, conf.export.jpeg_args),
+                             written, failed)
+    except Exception:
+        batch.filenames.release(path)
+        raise
+
+def _submit_clipping(batch, conf, drawable, vectors, visible, path, ext, pixels, colormap, on_written=None):
+    """Submit pixels, clipped from drawable (by vectors, if given), for export to path.
+
+    If the batch has a journal that shows the same clipping was exported unchanged to a file
+    that still exists, it is skipped instead; otherwise the journal records the export.
+    """
+    trace = batch.trace
+    journal = batch.journal if batch.target is None else None
+    if journal is None:
+        with trace.stage('submit'):
+            _submit_export(batch, conf, path, ext, pixels, colormap, on_written)
         return
-    e = ext.lower()
-    export_ok = _export(newimg, path)
-    if not export_ok:
-        pdb.gimp_message('%r file format currently not supported!' % e)
-    elif tagsource:
-        apply_src_tag(conf, path, image, drawable, vectors, nlayers)
-    pdb.gimp_image_delete(newimg)
-    pdb.gimp_buffer_delete(bname)
+    with trace.stage('journal'):
+        item = _journal_item(drawable, vectors, visible, path)
+        digest = _region_hash(pixels, colormap)
+        entry = journal.lookup(item)
+    if entry is not None and entry.status == 'done' and entry.hash == digest and os.path.exists(entry.path):
+        batch.encoder.skip(entry.path)
+        return
+    def done(path):
+        journal.record(item, digest, path, 'done')
+        if on_written:
+            on_written(path)
+    # a changed clipping (or one that never got written) replaces its earlier export
+    with trace.stage('submit'):
+        _submit_export(batch, conf, path, ext, pixels, colormap, done,
+                       lambda path: journal.record(item, digest, path, 'failed'),
+                       lambda path: journal.record(item, digest, path, 'started'),
+                       reuse=entry.path if entry else None, digest=digest)
+
+def _exportn(batch, image, drawable, suffix, visible, autocrop, tagsource, presuffix, colortoalpha, vectors, projection=None):
+    trace = batch.trace
+    trace.begin(item=drawable.name, vectors=vectors.name if vectors else None)
+    path = None
+    try:
+        conf = _load_config(image.filename)
+        nlayers = len(image.layers)
+        if visible:
+            nlayers = 1
+        with trace.stage('name'):
+            path, e = _export_path(conf, image, drawable, suffix, presuffix, nlayers)
+        def written(path):
+            if tagsource:
+                apply_src_tag(conf, path, image, drawable, vectors, nlayers)
+
+        newimg = bname = None
+        pixels = colormap = None
+        if _can_encode(e):
+            # nothing needs doing on the GIMP side, so read the pixels directly.
+            with trace.stage('extract'):
+                clipping = _extract_clipping(image, drawable, visible, projection)
+            if clipping is None:
+                pdb.gimp_message('Nothing to export: the selection doesn\'t intersect %s.' % drawable.name)
+                return
+            pixels, colormap = clipping
+            if colortoalpha != 0:
+                with trace.stage('colortoalpha'):
+                    pixels = _colortoalpha_contour(_with_alpha(pixels, colormap), colortoalpha)
+                colormap = None
+            if autocrop:
+                with trace.stage('autocrop'):
+                    pixels = _autocrop(pixels)
+        else:
+            dest = os.path.basename(path)
+            with trace.stage('copy'):
+                if visible:
+                    bname = pdb.gimp_edit_named_copy_visible(image, '_' + dest)
+                else:
+                    bname = pdb.gimp_edit_named_copy(drawable, '_' + dest)
+
+            # paste as new image (This doesn't automatically create a view, thankfully)
+            with indexed_handler(image) as ipalette:
+                with trace.stage('paste'):
+                    newimg = pdb.gimp_edit_named_paste_as_new(bname)
+                if ipalette:
+                    # pasting gives an RGB image; without NumPy, GIMP has to do the indexizing.
+                    if e != '.png':
+                        pdb.gimp_message('Only png format is currently supported for indexed export, falling back to non-indexed for %r.' % bname)
+                    else:
+                        with trace.stage('indexize'):
+                            apply_palette(newimg, ipalette)
+                if colortoalpha != 0:
+                    with trace.stage('colortoalpha'):
+                        colortoalpha_borders(newimg, newimg.layers[0], colortoalpha)
+                if autocrop:
+                    with trace.stage('autocrop'):
+                        pdb.plug_in_autocrop(newimg, newimg.layers[0])
+
+        if pixels is not None and colormap is None and e == '.png' and image.base_type == INDEXED and pixels.shape[2] >= 3:
+            # XXX in GIMP 2.9, non-binary alpha on an indexed image is possible and should be produced.
+            with trace.stage('indexize'):
+                indices = _indexize(pixels, image.colormap)
+            if indices is not None:
+                pixels, colormap = indices, image.colormap
+
+        if pixels is not None:
+            _submit_clipping(batch, conf, drawable, vectors, visible, path, e, pixels, colormap, written)
+        else:
+            with trace.stage('export'):
+                # get (and reserve) a filename that doesn't already exist on disk
+                path = batch.filenames.allocate(path)
+                try:
+                    exported = _export(newimg, path)
+                except Exception:
+                    batch.filenames.release(path)
+                    raise
+                if exported:
+                    batch.encoder.record(path)
+                    written(path)
+                else:
+                    pdb.gimp_message('%r file format currently not supported!' % e)
+                    batch.filenames.release(path)
+        if newimg is not None:
+            with trace.stage('cleanup'):
+                pdb.gimp_image_delete(newimg)
+                pdb.gimp_buffer_delete(bname)
+    finally:
+        trace.end(path=path)
 
 def exportfromvectors(image, drawable, visible, aa, feather, feather_radius, save_vectors=False, tagsource=True):
     pdb.gimp_image_undo_group_start(image)
@@ -849,11 +2579,13 @@ def exportfromvectors(image, drawable, visible, aa, feather, feather_radius, sav
     pdb.gimp_context_set_feather(feather)
     pdb.gimp_context_set_feather_radius(feather_radius, feather_radius)
     # process vectors bottom-to-top
-    for v in reversed(vectors):
-        name = v.name
-        pdb.gimp_image_select_item(image, CHANNEL_OP_REPLACE, v)
-        # XXX hardcoded autocrop=False
-        exportn(image, drawable, name, visible, False, tagsource, vectors=v)
+    with export_batch(image, journal=True) as batch:
+        for v in reversed(vectors):
+            name = v.name
+            pdb.gimp_image_select_item(image, CHANNEL_OP_REPLACE, v)
+            # XXX hardcoded autocrop=False
+            exportn(image, drawable, name, visible, False, tagsource, vectors=v)
+    _report(batch.summary)
     pdb.gimp_context_pop()
     if save_vectors:
         # export to $FILENAME-vectors.svg
@@ -861,15 +2593,19 @@ def exportfromvectors(image, drawable, visible, aa, feather, feather_radius, sav
         pdb.gimp_vectors_export_to_file(image, vfilename, None)
     pdb.gimp_image_undo_group_end(image)
 
-def gridtovectors(image, drawable, skipblanks, skipdupes):
-    # creates a set of rectangular vectors for use with exportfromvectors.
-    # only iterates through tiles within the selection, if there is a selection.
-    #
-    from hashlib import sha1
-    if not drawable:
-        drawable = image.active_drawable
+def _analyse_grid(image, drawable, skipblanks, skipdupes):
+    """Split the selection bounds (or the whole image, if there is no selection) into grid tiles,
+    and decide which ones to keep.
 
-    seen = set()
+    The drawable is read once, and reshaped into a (rows, cols, tile height, tile width, bpp) array.
+    A tile is visited if the selection is at least half-selected at its top left corner.
+    With skipblanks, tiles consisting of a single color are dropped; with skipdupes, tiles
+    identical to an earlier visited tile (in reading order) are dropped.
+
+    Partial tiles at the right and bottom are padded by repeating their edge pixels.
+    Areas outside the drawable read as zero.
+    """
+    import numpy as np
     gridw, gridh = pdb.gimp_image_grid_get_spacing(image)
     gridw = int(gridw)
     gridh = int(gridh)
@@ -877,30 +2613,113 @@ def gridtovectors(image, drawable, skipblanks, skipdupes):
     selw, selh = (image.width, image.height) if pdb.gimp_selection_is_empty(image) else (x2 - x1, y2 - y1)
     if selw % gridw or selh % gridh:
         pdb.gimp_message('Selection dimensions %dx%d are not evenly divisible by grid size %dx%d' % (selw, selh, gridw, gridh))
-    tovisit = []
-    for y in range(0, selh, gridh):
-        for x in range(0, selw, gridw):
-            if issel:
-                 if pdb.gimp_selection_value(image, x1 + x, y1 + y) >= 128:
-                     tovisit.append((x1 + x, y1 + y))
+    rows, cols = -(-selh // gridh), -(-selw // gridw)
+    bpp = drawable.bpp
+    region = np.zeros((selh, selw, bpp), dtype=np.uint8)
+    ox, oy = drawable.offsets
+    # the part of the drawable within the selection bounds, in drawable coordinates
+    dx1, dy1 = max(x1 - ox, 0), max(y1 - oy, 0)
+    dx2, dy2 = min(x1 + selw - ox, drawable.width), min(y1 + selh - oy, drawable.height)
+    if dx2 > dx1 and dy2 > dy1:
+        data = drawable.get_pixel_rgn(dx1, dy1, dx2 - dx1, dy2 - dy1, False, False)[dx1:dx2, dy1:dy2]
+        region[dy1 + oy - y1:dy2 + oy - y1, dx1 + ox - x1:dx2 + ox - x1] = \
+            np.frombuffer(data, dtype=np.uint8).reshape(dy2 - dy1, dx2 - dx1, bpp)
+    region = np.pad(region, ((0, rows * gridh - selh), (0, cols * gridw - selw), (0, 0)), 'edge')
+    tiles = region.reshape(rows, gridh, cols, gridw, bpp).swapaxes(1, 2)
+
+    keep = np.ones((rows, cols), dtype=bool)
+    if issel:
+        sel = image.selection.get_pixel_rgn(x1, y1, selw, selh, False, False)[x1:x1 + selw, y1:y1 + selh]
+        sel = np.frombuffer(sel, dtype=np.uint8).reshape(selh, selw)
+        keep &= sel[::gridh, ::gridw] >= 128
+    if skipblanks:
+        keep &= ~(tiles == tiles[:, :, :1, :1, :]).all(axis=(2, 3, 4))
+    if skipdupes:
+        visited = np.flatnonzero(keep)
+        flat = np.ascontiguousarray(tiles).reshape(rows * cols, -1)[visited]
+        # hash each tile as a weighted sum of its 64-bit words (mod 2**64),
+        # then confirm that tiles with equal hashes really are equal.
+        padding = -flat.shape[1] % 8
+        if padding:
+            flat = np.pad(flat, ((0, 0), (0, padding)), 'constant')
+        words = flat.view(np.uint64)
+        weights = np.random.RandomState(0).randint(1, 2 ** 31, size=words.shape[1]).astype(np.uint64) * 2 + 1
+        hashes = (words * weights).sum(axis=1)
+        _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+        original = first[inverse]
+        dupe = (original != np.arange(len(visited))) & (flat == flat[original]).all(axis=1)
+        keep.ravel()[visited[dupe]] = False
+    colormap = image.colormap if drawable.is_indexed else None
+    return GridAnalysis(x1, y1, selw, selh, gridw, gridh, tiles, keep, colormap)
+
+def _grid_tiles_pdb(image, drawable, skipblanks, skipdupes):
+    """Decide which grid tiles to keep like _analyse_grid does, without NumPy.
+
+    Returns (grid width, grid height, [(x, y) image coordinates of each kept tile, in reading order]).
+    Each tile is read separately. Areas outside the drawable read as zero; partial tiles at the
+    right and bottom are compared as they are, rather than padded.
+    """
+    from hashlib import sha1
+    gridw, gridh = pdb.gimp_image_grid_get_spacing(image)
+    gridw = int(gridw)
+    gridh = int(gridh)
+    issel, x1, y1, x2, y2 = pdb.gimp_selection_bounds(image)
+    selw, selh = (image.width, image.height) if pdb.gimp_selection_is_empty(image) else (x2 - x1, y2 - y1)
+    if selw % gridw or selh % gridh:
+        pdb.gimp_message('Selection dimensions %dx%d are not evenly divisible by grid size %dx%d' % (selw, selh, gridw, gridh))
+    ox, oy = drawable.offsets
+    bpp = drawable.bpp
+    pr = drawable.get_pixel_rgn(0, 0, drawable.width, drawable.height, False, False)
+    seen = set()
+    tiles = []
+    for y in range(y1, y1 + selh, gridh):
+        for x in range(x1, x1 + selw, gridw):
+            if issel and pdb.gimp_selection_value(image, x, y) < 128:
+                continue
+            tw, th = min(gridw, x1 + selw - x), min(gridh, y1 + selh - y)
+            # the part of the tile within the drawable, in drawable coordinates
+            dx1, dy1 = max(x - ox, 0), max(y - oy, 0)
+            dx2, dy2 = min(x + tw - ox, drawable.width), min(y + th - oy, drawable.height)
+            blankrow = '\0' * (tw * bpp)
+            if dx2 > dx1 and dy2 > dy1:
+                data = pr[dx1:dx2, dy1:dy2]
+                stride = (dx2 - dx1) * bpp
+                left = '\0' * ((dx1 + ox - x) * bpp)
+                right = '\0' * ((x + tw - ox - dx2) * bpp)
+                tile = ''.join([blankrow] * (dy1 + oy - y) +
+                               [left + data[i:i + stride] + right for i in range(0, len(data), stride)] +
+                               [blankrow] * (y + th - oy - dy2))
             else:
-                 tovisit.append((x1 + x, y1 + y))
-    pr = drawable.get_pixel_rgn(x1, y1, selw, selh, False, False)
-    npixels = gridw * gridh
+                tile = blankrow * th
+            if skipblanks and tile == tile[:bpp] * (len(tile) // bpp):
+                continue
+            if skipdupes:
+                key = (tw, th, sha1(tile).digest())
+                if key in seen:
+                    continue
+                seen.add(key)
+            tiles.append((x, y))
+    return gridw, gridh, tiles
+
+def gridtovectors(image, drawable, skipblanks, skipdupes):
+    # creates a set of rectangular vectors for use with exportfromvectors.
+    # only iterates through tiles within the selection, if there is a selection.
+    #
+    if not drawable:
+        drawable = image.active_drawable
+
+    try:
+        import numpy as np
+    except ImportError:
+        gridw, gridh, tiles = _grid_tiles_pdb(image, drawable, skipblanks, skipdupes)
+    else:
+        grid = _analyse_grid(image, drawable, skipblanks, skipdupes)
+        gridw, gridh = grid.gridw, grid.gridh
+        tiles = [(grid.x + col * gridw, grid.y + row * gridh) for row, col in zip(*np.nonzero(grid.keep))]
     pdb.gimp_image_undo_group_start(image)
     vector_count  = 0
-    for xc, yc in tovisit:
-        # get tile content
-        tile = pr[xc:xc+gridw, yc:yc+gridw]
-        pixel1 = pr[xc, yc]
-        # pixelrgn..
-        tilehash = sha1(tile).digest()
-        if skipdupes and tilehash in seen:
-            continue
-        # XXX is pixel1 a string/bytestring, which is what we want here? or a tuple, which isn't?
-        if skipblanks and pixel1 * npixels == tile:
-            continue
-        name = '%03d_%03d' % ((x1 + xc) / gridw, (y1 + yc) / gridh)
+    for xc, yc in tiles:
+        name = '%03d_%03d' % (xc // gridw, yc // gridh)
         vec = pdb.gimp_vectors_new(image, name)
         pdb.gimp_image_insert_vectors(image, vec, None, 0)
         # CACCACCACCAC
@@ -911,10 +2730,66 @@ def gridtovectors(image, drawable, skipblanks, skipdupes):
             xc, yc+gridh, xc, yc+gridh, xc, yc+gridh],
           True)
         vector_count += 1
-        seen.add(tilehash)
     print ('Total vectors added: %d' % vector_count)
     pdb.gimp_image_undo_group_end(image)
 
+def exportgrid(image, drawable, skipblanks, skipdupes, tagsource, colortoalpha=1):
+    # like gridtovectors followed by exportfromvectors (with visible=False), but tiles go straight to file,
+    # without creating any vectors, selections or undo steps.
+    # As there, colortoalpha is applied around the contours of each tile, and the export is journalled,
+    # so rerunning it skips tiles that were already exported unchanged.
+    try:
+        import numpy as np
+    except ImportError:
+        pdb.gimp_message('Export Grid Slices requires NumPy; use Grid to Vectors and Export Clippings from Vectors instead.')
+        return
+    if not drawable:
+        drawable = image.active_drawable
+    if not image.filename:
+        pdb.gimp_message('Image must be saved on disk before exporting clippings.')
+        return
+    conf = _load_config(image.filename)
+    nlayers = len(image.layers)
+    grid = _analyse_grid(image, drawable, skipblanks, skipdupes)
+    gridw, gridh = grid.gridw, grid.gridh
+    ox, oy = drawable.offsets
+    def written(path):
+        if tagsource:
+            apply_src_tag(conf, path, image, drawable, None, nlayers)
+    with export_batch(image, journal=True) as batch:
+        for row, col in zip(*np.nonzero(grid.keep)):
+            x = grid.x + col * gridw
+            y = grid.y + row * gridh
+            w = min(gridw, grid.width - col * gridw)
+            h = min(gridh, grid.height - row * gridh)
+            # as with a selection, only the part of the tile that is within the drawable is exported
+            tx1, ty1 = max(x, ox), max(y, oy)
+            tx2, ty2 = min(x + w, ox + drawable.width), min(y + h, oy + drawable.height)
+            if tx2 <= tx1 or ty2 <= ty1:
+                continue
+            name = '%03d_%03d' % (x // gridw, y // gridh)
+            # template variables see the tile as the clipping area
+            bounds = (tx1 - ox, ty1 - oy, tx2 - ox, ty2 - oy)
+            path, e = _export_path(conf, image, drawable, name, '', nlayers, bounds)
+            if not _can_encode(e):
+                pdb.gimp_message('%r files can\'t be written directly; use Grid to Vectors and Export Clippings from Vectors instead.' % e)
+                break
+            pixels = grid.tiles[row, col, ty1 - y:ty2 - y, tx1 - x:tx2 - x]
+            colormap = grid.colormap
+            if colortoalpha != 0:
+                pixels = _colortoalpha_contour(_with_alpha(pixels, colormap), colortoalpha)
+                colormap = None
+                # as in _exportn, png exports of indexed images are indexed again afterwards
+                if e == '.png' and image.base_type == INDEXED:
+                    indices = _indexize(pixels, image.colormap)
+                    if indices is not None:
+                        pixels, colormap = indices, image.colormap
+            elif not drawable.has_alpha:
+                # the selection would be added as alpha
+                pixels = np.dstack((pixels, np.full(pixels.shape[:2], 255, dtype=np.uint8)))
+            _submit_clipping(batch, conf, drawable, None, False, path, e, pixels, colormap, written)
+    _report(batch.summary)
+
 def serialexport(image, drawable):
     if not drawable:
         drawable = image.active_drawable
@@ -932,52 +2807,111 @@ def exportlayers(image, drawable, keep_bg, tagsource):
     if not image.filename:
         pdb.gimp_message('Image must be saved on disk before exporting layers.')
         return
-    with undogroup(image):
-        for i, layer in iterate_layer_visibility(image, keep_bg):
-            exportn(image, layer, layer.name, True, False, tagsource, vectors=None)
-
-
+    working_set = image.layers[:-1] if keep_bg else image.layers
+    compositor = None
+    # the output format comes from the name template, so is the same for every layer.
+    # with keep_bg, the background is composited too, so it must be supported as well.
+    if working_set and _can_encode(_export_path(_load_config(image.filename), image, working_set[0], '', '', 1)[1]) and all(
+            _LayerCompositor.supports(l) for l in image.layers):
+        # no need to touch visibility at all, or to have GIMP render the projection for every layer.
+        compositor = _LayerCompositor(image, image.layers[-1] if keep_bg else None)
+    with undogroup(image), export_batch(image, journal=True) as batch:
+        if compositor is not None:
+            for layer in working_set:
+                _exportn(batch, image, layer, layer.name, True, False, tagsource, '', 1, None,
+                         projection=compositor.composite(layer))
+        else:
+            for i, layer in iterate_layer_visibility(image, keep_bg):
+                exportn(image, layer, layer.name, True, False, tagsource, vectors=None)
+    _report(batch.summary)
+
+
+
+# buffer names carry [[IWIDTHxIHEIGHT+OX,OY]]: the size of the source image and the offset of the clipping within it.
+_placement_re = re.compile(r'\[\[([0-9]+)x([0-9]+)\+([0-9]+),([0-9]+)\]\]')
+
+def _buffer_placement(name, image):
+    """Return the (x, y) offset to paste buffer name at in image, or None if it came from an image of another size."""
+    srcinfo = _placement_re.findall(name)
+    if srcinfo:
+        _sw, _sh, _sx, _sy = [ int(v) for v in srcinfo[-1]]
+        if _sw == image.width and _sh == image.height:
+            return _sx, _sy
+    return None
 
-def _pastenandremove(image, drawable, read_index, pasteinto):
-    import re
+def _paste_target(image, drawable):
+    """Return (drawable to paste onto, parent to put the pasted layers in)."""
     # ugh, why is drawable usually None????
     if not drawable:
         drawable = image.active_drawable
-    conf = _load_config(image.filename)
-    pasteinto = 1 if pasteinto else 0
     # if this is a layer group, pick an arbitrary layer to paste 'onto', we reorder later anyway
     if pdb.gimp_item_is_group(drawable):
         parent = drawable
         drawable = [l for l in image.layers if not pdb.gimp_item_is_group(l)][0]
     else:
         parent = pdb.gimp_item_get_parent(drawable)
-    _, buffers = pdb.gimp_buffers_get_list('')
-    if not buffers:
-        return
-    this = buffers[read_index]
-    # detect [[IWIDTHxIHEIGHT+OX,OY]]
-    destx, desty = None, None
-    srcinfo = re.findall('\[\[([0-9]+)x([0-9]+)+([0-9]+),([0-9]+)\]\]', this)
-    if srcinfo:
-        _sw, _sh, _sx, _sy = [ int(v) for v in srcinfo[-1]]
-        if _sw == image.width and _sh == image.height:
-            destx = _sx
-            desty = _sy
-    print('original buffer name: %r' % this)
-    final = _apply_regexp_substitutions(this, conf.stack.name_edits)
+    return drawable, parent
+
+def _paste_buffer(image, drawable, parent, name, name_edits, pasteinto, buffer=None):
+    """Paste buffer name (or buffer, if given) as a new layer, placed and named according to name."""
+    placement = _buffer_placement(name, image)
+    print('original buffer name: %r' % name)
+    final = _apply_regexp_substitutions(name, name_edits)
     print('final buffer name: %r' % final)
-    pdb.gimp_image_undo_group_start(image)
-    fsel = pdb.gimp_edit_named_paste(drawable, this, pasteinto)
+    fsel = pdb.gimp_edit_named_paste(drawable, buffer or name, pasteinto)
     pdb.gimp_floating_sel_to_layer(fsel)
     newlayer = image.active_layer
-    if destx is not None:
-        newlayer.set_offsets(destx, desty)
+    if placement is not None:
+        newlayer.set_offsets(*placement)
     pdb.gimp_item_set_name(newlayer, final)
     if parent:
         pdb.gimp_image_reorder_item(image, newlayer, parent, 0)
+    return newlayer
+
+def _paste_stack_entry(image, drawable, parent, stack, entry, name_edits, pasteinto):
+    """Paste a _DiskStack entry like _paste_buffer does, through a temporary buffer."""
+    bname = stack.to_buffer(entry)
+    try:
+        return _paste_buffer(image, drawable, parent, entry.name, name_edits, pasteinto, bname)
+    finally:
+        pdb.gimp_buffer_delete(bname)
+
+def _pastenandremove(image, drawable, read_index, pasteinto):
+    conf = _load_config(image.filename)
+    pasteinto = 1 if pasteinto else 0
+    drawable, parent = _paste_target(image, drawable)
+    stack = _disk_stack(conf)
+    if stack is not None:
+        if not stack.entries:
+            return
+        this = stack.entries[read_index]
+        pdb.gimp_image_undo_group_start(image)
+        try:
+            _paste_stack_entry(image, drawable, parent, stack, this, conf.stack.name_edits, pasteinto)
+        finally:
+            pdb.gimp_image_undo_group_end(image)
+        stack.remove([this])
+        return
+    _, buffers = pdb.gimp_buffers_get_list('')
+    if not buffers:
+        return
+    this = buffers[read_index]
+    pdb.gimp_image_undo_group_start(image)
+    _paste_buffer(image, drawable, parent, this, conf.stack.name_edits, pasteinto)
     pdb.gimp_image_undo_group_end(image)
     pdb.gimp_buffer_delete(this)
-
+    _BufferIndex().remove([this])
+
+def _read_order(buffers, read_index):
+    """Return buffers in the order that repeatedly taking buffers[read_index] off the list would give."""
+    remaining = list(buffers)
+    order = []
+    while remaining:
+        try:
+            order.append(remaining.pop(read_index))
+        except IndexError:
+            break
+    return order
 
 def copynauto(image, drawable):
     _copyn(image, drawable)
@@ -990,19 +2924,74 @@ def pastenandremove(image, drawable):
     _pastenandremove(image, drawable, conf.stack.read_index, 0)
 
 def pastenallandremove(image, drawable):
+    # The buffer list is read once; buffers are only deleted after all of them have been pasted.
+    conf = _load_config(image.filename)
+    stack = _disk_stack(conf)
+    if stack is not None:
+        drawable, parent = _paste_target(image, drawable)
+        pasted = []
+        pdb.gimp_image_undo_group_start(image)
+        try:
+            for entry in _read_order(stack.entries, conf.stack.read_index):
+                _paste_stack_entry(image, drawable, parent, stack, entry, conf.stack.name_edits, 0)
+                pasted.append(entry)
+        finally:
+            pdb.gimp_image_undo_group_end(image)
+            stack.remove(pasted)
+        return
     _, buffers = pdb.gimp_buffers_get_list('')
+    if not buffers:
+        return
+    drawable, parent = _paste_target(image, drawable)
+    pasted = []
+    pdb.gimp_image_undo_group_start(image)
+    try:
+        for name in _read_order(buffers, conf.stack.read_index):
+            _paste_buffer(image, drawable, parent, name, conf.stack.name_edits, 0)
+            pasted.append(name)
+    finally:
+        pdb.gimp_image_undo_group_end(image)
+        for name in pasted:
+            pdb.gimp_buffer_delete(name)
+        _BufferIndex().remove(pasted)
+
+def pastematchingandremove(image, drawable, pattern, thisimage, allmatches):
+    # Looks clippings up in the stack index rather than the buffer list, so only clippings copynaut put on the stack are found.
     conf = _load_config(image.filename)
+    stack = _disk_stack(conf)
+    index = stack if stack is not None else _BufferIndex()
+    matches = index.matching(pattern, _stack_source(image) if thisimage else None)
+    if not matches:
+        pdb.gimp_message('No clippings on the stack match %r%s.' % (pattern, ' from this image' if thisimage else ''))
+        return
+    order = _read_order(matches, conf.stack.read_index)
+    if not allmatches:
+        order = order[:1]
+    drawable, parent = _paste_target(image, drawable)
+    pasted = []
     pdb.gimp_image_undo_group_start(image)
-    for i, _ in enumerate(buffers):
-        _pastenandremove(image, drawable, conf.stack.read_index, 0)
-    pdb.gimp_image_undo_group_end(image)
+    try:
+        for entry in order:
+            if stack is not None:
+                _paste_stack_entry(image, drawable, parent, stack, entry, conf.stack.name_edits, 0)
+            else:
+                _paste_buffer(image, drawable, parent, entry.name, conf.stack.name_edits, 0)
+            pasted.append(entry)
+    finally:
+        pdb.gimp_image_undo_group_end(image)
+        if stack is not None:
+            stack.remove(pasted)
+        else:
+            for entry in pasted:
+                pdb.gimp_buffer_delete(entry.name)
+            index.remove([e.name for e in pasted])
 
 def configure(stacktemplate, exporttemplate, directory):
     conf = _load_config('')
-    stackc = StackConfig(conf.stack.read_index, stacktemplate, conf.stack.name_edits)
+    stackc = conf.stack._replace(name_template=stacktemplate)
     if directory is None:
         directory = ''
-    exportc = ExportConfig(exporttemplate, conf.export.name_edits, directory, conf.export.webp_args, conf.export.jpeg_args)
+    exportc = conf.export._replace(name_template=exporttemplate, directory=directory)
     newconf = Config(stackc, exportc)
     _save_config(newconf, _getconfigpath())
 
@@ -1053,7 +3042,7 @@ register(
 register(
     proc_name="python-fu-colortoalpha-borders",
     blurb="Apply colortoalpha to contours of partially-transparent image",
-    help="Shrinks the alpha mask by N steps, in the manner of Select->Shrink, inverts it, traces it into a path for smoothing, and applies color to alpha."
+    help="Takes the band within N pixels of the transparent area, in the manner of Select->Grow on the inverted alpha, and applies color to alpha (white) within it."
          " Overall effect is to remove white 'haloing' from extracted objects (eg. areas cut out from a scanned drawing)."
          " Radius values < 0 are equivalent to 'use current selection mask'."
     ,
@@ -1113,6 +3102,30 @@ register(
     domain=("gimp20-python", gimp.locale_directory)
     )
 
+register(
+    proc_name="python-fu-paste-matching-and-remove",
+    blurb="Paste the next clipping on the stack whose name or layer path matches a pattern, and remove it.",
+    help=("pattern is a glob pattern, such as '*face*', matched against the clipping's name and the layer path it was copied from. "
+          "With thisimage, only clippings copied from this image are considered; with allmatches, all matching clippings are pasted, "
+          "in the order set by the clipping stack mode. Only clippings copied with copynaut are found."),
+    author="David Gowers",
+    copyright="David Gowers",
+    date=("2015"),
+    label=("Paste _Matching Named and Remove..."),
+    imagetypes=("*"),
+    params=[
+            (PF_IMAGE, "image", "image", None),
+            (PF_LAYER, "drawable", "drawable", None),
+            (PF_STRING, "pattern", "Pattern", "*"),
+            (PF_BOOL, "thisimage", "Only clippings from this image", 1),
+            (PF_BOOL, "allmatches", "Paste all matches", 0),
+            ],
+    results=[],
+    function=pastematchingandremove,
+    menu=("<Image>/Edit/Buffer"),
+    domain=("gimp20-python", gimp.locale_directory)
+    )
+
 register(
     proc_name="python-fu-exportclipping",
     blurb="Export current selection to file",
@@ -1207,6 +3220,32 @@ register(
     domain=("gimp20-python", gimp.locale_directory)
     )
 
+register(
+    proc_name="python-fu-export-grid-slices",
+    blurb="Export each grid 'tile' within the current selection (or entire image if there is no selection) to a file",
+    help=("Equivalent to python-fu-grid-to-vectors followed by python-fu-export-clippings-from-vectors without 'Copy Visible', "
+          "but much faster, since no vectors objects or selections are created. Requires NumPy. "
+          "colortoalpha applies colortoalpha, smoothly, around the contours of each tile, "
+          "with the specified radius (0 meaning 'Don't apply'); Export Clippings from Vectors uses 1."),
+    author="David Gowers",
+    copyright="David Gowers",
+    date=("2015"),
+    label=("Export Grid Slices"),
+    imagetypes=("*"),
+    params=[
+            (PF_IMAGE, "image", "image", None),
+            (PF_LAYER, "drawable", "drawable", None),
+            (PF_BOOL, "skipblanks", "Ignore _Blanks", True),
+            (PF_BOOL, "skipdupes", "Ignore _Duplicates", True),
+            (PF_BOOL, "tagsource", "TMSU tag source_info", True),
+            (PF_INT, "colortoalpha", "_Colortoalpha edge radius", 1),
+            ],
+    results=[],
+    function=exportgrid,
+    menu=("<Image>/File"),
+    domain=("gimp20-python", gimp.locale_directory)
+    )
+
 register(
     proc_name="python-fu-grid-to-vectors",
     blurb="Create a vectors object for each grid 'tile' within the current selection (or entire image if there is no selection)",
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# Copynaut batch driver
+#
+# Exports clippings from many image files without the GIMP user interface, by running copynaut's
+# export procedures in a number of 'gimp -i' batch workers and collecting their results into one report.
+#
+# This is a command-line script, not a plug-in: don't copy it into your plug-ins directory.
+# copynaut.py must be installed there, as usual.
+#
+# Each worker is started as
+#
+#   GIMP -i --batch-interpreter python-fu-eval -b CODE -b 'pdb.gimp_quit(1)'
+#
+# where CODE loads the worker's files one after another and runs the export procedure on each.
+# Around each file, CODE prints lines starting with 'COPYNAUT-BEGIN ' and 'COPYNAUT-END ', followed by JSON;
+# GIMP messages printed in between (such as copynaut's 'Exported N files' report) are attributed to that file.
+# --gimp can name a stand-in for GIMP that does the same, for testing (see tests/fake_gimp.py).
+#
+# The workers already run in parallel, so each one's exports are encoded with --encode-processes
+# processes (1 by default) rather than the 'encode processes' setting, which defaults to one per CPU.
+# This is passed to copynaut in the COPYNAUT_ENCODE_PROCESSES environment variable.
+#
+# Works with Python 2.7 and 3.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BEGIN = 'COPYNAUT-BEGIN '
+END = 'COPYNAUT-END '
+
+# Runs inside GIMP's python-fu-eval interpreter (Python 2). %(jobfile)r holds the arguments.
+WORKER_CODE = """
+import json, time, traceback
+def _copynaut_worker(jobfile):
+    import sys
+    with open(jobfile) as f:
+        job = json.load(f)
+    # GIMP messages go to stderr in batch mode, which the driver reads along with stdout
+    pdb.gimp_message_set_handler(1)
+    for filename in job['files']:
+        if not isinstance(filename, str):
+            filename = filename.encode('utf-8')
+        print('%(begin)s' + json.dumps({'file': filename}))
+        sys.stdout.flush()
+        start = time.time()
+        result = {'file': filename, 'status': 'ok', 'error': None}
+        try:
+            image = pdb.gimp_file_load(filename, filename)
+            try:
+                drawable = image.active_drawable or image.layers[0]
+                if job['procedure'] == 'layers':
+                    pdb.python_fu_export_layers(image, drawable, job['keep_bg'], job['tagsource'])
+                else:
+                    pdb.python_fu_export_clippings_from_vectors(image, drawable, job['visible'], job['aa'],
+                                                                job['feather'], job['feather_radius'],
+                                                                job['save_vectors'], job['tagsource'])
+            finally:
+                pdb.gimp_image_delete(image)
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = traceback.format_exc().strip().splitlines()[-1]
+        result['seconds'] = time.time() - start
+        sys.stderr.flush()
+        print('%(end)s' + json.dumps(result))
+        sys.stdout.flush()
+_copynaut_worker(%(jobfile)r)
+"""
+
+# copynaut's end-of-batch report
+_exported_re = re.compile(r'Exported (\d+) files \(([0-9.]+) kB\)\.')
+_skipped_re = re.compile(r'(\d+) unchanged clippings skipped\.')
+_failed_re = re.compile(r'(\d+) exports failed\.')
+
+
+def distribute(files, workers):
+    """Split files into at most workers lists of about the same total size, largest files first.
+
+    Among lists of the same size, a file goes to the one with the fewest files.
+    """
+    sizes = []
+    for f in files:
+        try:
+            sizes.append((os.path.getsize(f), f))
+        except OSError:
+            sizes.append((0, f))
+    sizes.sort(key=lambda v: -v[0])
+    loads = [[0, []] for i in range(max(1, min(workers, len(files))))]
+    for size, f in sizes:
+        load = min(loads, key=lambda l: (l[0], len(l[1])))
+        load[0] += size
+        load[1].append(f)
+    return [l[1] for l in loads if l[1]]
+
+
+def parse_output(output, files):
+    """Return a result dict for each of files, from a worker's output.
+
+    Files the worker never finished (because it crashed, say) are reported as failed.
+    """
+    results = {}
+    current = None
+    for line in output.splitlines():
+        if line.startswith(BEGIN):
+            current = json.loads(line[len(BEGIN):])['file']
+            results[current] = dict(file=current, status='failed', error='worker stopped', seconds=None, messages=[])
+        elif line.startswith(END):
+            result = json.loads(line[len(END):])
+            result['messages'] = results.get(result['file'], {}).get('messages', [])
+            results[result['file']] = result
+            current = None
+        elif current is not None and line.strip():
+            results[current]['messages'].append(line.strip())
+    report = []
+    for f in files:
+        result = results.get(f) or dict(file=f, status='failed', error='not started', seconds=None, messages=[])
+        counts = dict(written=0, nbytes=0, skipped=0, failed=0)
+        for message in result['messages']:
+            m = _exported_re.search(message)
+            if m:
+                counts['written'] += int(m.group(1))
+                counts['nbytes'] += int(float(m.group(2)) * 1024)
+            m = _skipped_re.search(message)
+            if m:
+                counts['skipped'] += int(m.group(1))
+            m = _failed_re.search(message)
+            if m:
+                counts['failed'] += int(m.group(1))
+        result.update(counts)
+        report.append(result)
+    return report
+
+
+def run_worker(gimp, job, results, index, env=None):
+    """Run one GIMP batch worker on job (see WORKER_CODE), storing its report in results[index].
+
+    env, if given, is the worker's environment.
+    """
+    fd, jobfile = tempfile.mkstemp(prefix='copynaut-job-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        code = WORKER_CODE % dict(begin=BEGIN, end=END, jobfile=jobfile)
+        args = [gimp, '-i', '--batch-interpreter', 'python-fu-eval', '-b', code, '-b', 'pdb.gimp_quit(1)']
+        try:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        except OSError as e:
+            results[index] = [dict(file=f, status='failed', error='could not run %s: %s' % (gimp, e),
+                                   seconds=None, messages=[], written=0, nbytes=0, skipped=0, failed=0)
+                              for f in job['files']]
+            return
+        output = proc.communicate()[0].decode('utf-8', 'replace')
+        results[index] = parse_output(output, job['files'])
+        if proc.returncode:
+            for r in results[index]:
+                if r['status'] == 'failed' and r['error'] in ('worker stopped', 'not started'):
+                    r['error'] += ' (exit status %d)' % proc.returncode
+    finally:
+        os.remove(jobfile)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export clippings from many image files at once, using several GIMP batch workers.')
+    parser.add_argument('files', nargs='+', help='image files to export from')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='number of GIMP workers to run at once (default: one per CPU)')
+    parser.add_argument('--encode-processes', type=int, default=1, metavar='N',
+                        help='number of processes each worker encodes exported files with, '
+                             'overriding copynaut\'s "encode processes" setting (default: 1; 0: one per CPU)')
+    parser.add_argument('--gimp', default=os.environ.get('GIMP', 'gimp'),
+                        help='GIMP executable, or a stand-in accepting the same arguments (default: $GIMP or gimp)')
+    parser.add_argument('--layers', action='store_true',
+                        help='export each layer (python-fu-export-layers) instead of clippings from vectors')
+    parser.add_argument('--no-keep-bg', dest='keep_bg', action='store_false',
+                        help='with --layers, don\'t keep the bottom layer under each exported layer')
+    parser.add_argument('--no-visible', dest='visible', action='store_false',
+                        help='clip the active layer rather than the visible image')
+    parser.add_argument('--no-antialias', dest='aa', action='store_false', help='don\'t antialias vector selections')
+    parser.add_argument('--feather', type=float, default=None, metavar='RADIUS',
+                        help='feather vector selections by RADIUS pixels')
+    parser.add_argument('--no-svg', dest='save_vectors', action='store_false',
+                        help='don\'t also export vectors to IMAGE-vectors.svg')
+    parser.add_argument('--no-tag', dest='tagsource', action='store_false', help='don\'t TMSU-tag exported files')
+    parser.add_argument('--report', metavar='FILE', help='also write the full report to FILE, as JSON')
+    args = parser.parse_args(argv)
+
+    jobs = args.jobs
+    if jobs <= 0:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    files = [os.path.abspath(f) for f in args.files]
+    settings = dict(procedure='layers' if args.layers else 'vectors', keep_bg=args.keep_bg, visible=args.visible,
+                    aa=args.aa, feather=args.feather is not None, feather_radius=args.feather or 5.0,
+                    save_vectors=args.save_vectors, tagsource=args.tagsource)
+    env = dict(os.environ, COPYNAUT_ENCODE_PROCESSES=str(args.encode_processes))
+    start = time.time()
+    groups = distribute(files, jobs)
+    results = [None] * len(groups)
+    threads = []
+    for i, group in enumerate(groups):
+        job = dict(settings, files=group)
+        t = threading.Thread(target=run_worker, args=(args.gimp, job, results, i, env))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    byfile = dict((r['file'], r) for group in results for r in group)
+    report = [byfile[f] for f in files]
+    totals = dict(files=len(report), failed_files=sum(1 for r in report if r['status'] != 'ok'),
+                  workers=len(groups), seconds=time.time() - start)
+    for k in ('written', 'nbytes', 'skipped', 'failed'):
+        totals[k] = sum(r[k] for r in report)
+    for r in report:
+        if r['status'] != 'ok':
+            print('%s: %s' % (r['file'], r['error']), file=sys.stderr)
+    print('%(files)d files, %(failed_files)d failed; exported %(written)d clippings (%(nbytes)d bytes), '
+          '%(skipped)d skipped, %(failed)d failed; %(workers)d workers, %(seconds).1f s' % totals)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(dict(totals=totals, files=report), f, indent=1, sort_keys=True)
+    return 1 if totals['failed_files'] or totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,8 @@
 
 from gimpfu import *
 from array import array
+from collections import namedtuple
+from contextlib import contextmanager
 
 gettext.install("gimp20-python", gimp.locale_directory, unicode=True)
 
@@ -11,6 +13,16 @@ RENAME, IGNORE = 0, 1
 PRI_RNS, PRI_NRS, PRI_SRN, PRI_NSR = 0, 1, 2, 3
 ACTIVEGROUP, ALL = 0, 1
 IGNORE_SEL, IN_SEL, NOT_IN_SEL = 0, 1, 2
+IGNORE_CONTENT, EMPTY, NOT_EMPTY = 0, 1, 2
+BY_NOTHING, BY_AREA, BY_LUMINANCE, BY_HUE, BY_BBOX, BY_SIMILARITY = range(6)
+STATS_PARASITE_NAME = 'layer-content-stats'
+PHASH_PARASITE_NAME = 'layer-perceptual-hashes'
+
+LayerStats = namedtuple('LayerStats', 'area luminance hue bbox')
+# layer ID -> (content key, fingerprint, LayerStats), so sorting and filtering in one run look at each layer once.
+_stats_cache = {}
+# layer ID -> (layer, parasite data) for stats computed in this run, attached by _save_stats()
+_unsaved_stats = {}
 
 def _tosort(layerlist, parent = None, depth = 0):
     """Returns a list of lists of layers to sort, depth-first"""
@@ -26,10 +38,50 @@ def _tosort(layerlist, parent = None, depth = 0):
     return layers
 
 
-def _applysort(image, layers):
-    for l in reversed(layers):
-        print('L=', l)
-        pdb.gimp_image_raise_item_to_top(image, l)
+def _longest_increasing_subsequence(seq):
+    """Returns the set of indices into seq forming one of its longest strictly increasing subsequences."""
+    from bisect import bisect_left
+    tails = []
+    tail_indices = []
+    predecessor = [None] * len(seq)
+    for i, v in enumerate(seq):
+        pos = bisect_left(tails, v)
+        if pos == len(tails):
+            tails.append(v)
+            tail_indices.append(i)
+        else:
+            tails[pos] = v
+            tail_indices[pos] = i
+        predecessor[i] = tail_indices[pos - 1] if pos else None
+    keep = set()
+    i = tail_indices[-1] if tail_indices else None
+    while i is not None:
+        keep.add(i)
+        i = predecessor[i]
+    return keep
+
+
+def _applysort(image, parent, layers):
+    """Reorder the children of parent so that layers are on top, in the given order.
+
+    Only layers outside the longest run already in the right relative order are moved,
+    so re-sorting an almost-sorted group costs a handful of reorders rather than one per layer.
+    """
+    current = list(parent.children if parent else image.layers)
+    ids = set(l.ID for l in layers)
+    # layers that aren't being sorted (ie. groups) stay below the sorted ones, in their original order.
+    target = list(layers) + [l for l in current if l.ID not in ids]
+    rank = dict((l.ID, i) for i, l in enumerate(target))
+    keep = set(current[i].ID for i in _longest_increasing_subsequence([rank[l.ID] for l in current]))
+    for i, l in enumerate(target):
+        if l.ID in keep:
+            continue
+        current = [c for c in current if c.ID != l.ID]
+        position = 0
+        if i:
+            position = [c.ID for c in current].index(target[i - 1].ID) + 1
+        current.insert(position, l)
+        pdb.gimp_image_reorder_item(image, l, parent, position)
 
 
 def _affected_layers(image, scope):
@@ -43,18 +95,376 @@ def _affected_layers(image, scope):
 
 
 
-def matches(drawable,  pattern, selection):
+@contextmanager
+def _caching(image):
+    """Attach cache parasites to image or its layers within this block.
+
+    Undo is frozen, so the caches don't show up in the undo history; call this outside of any undo group.
+    If image had no unsaved changes before, it is marked clean again afterwards.
+    """
+    dirty = pdb.gimp_image_is_dirty(image)
+    pdb.gimp_image_undo_freeze(image)
+    try:
+        yield
+    finally:
+        pdb.gimp_image_undo_thaw(image)
+        if not dirty:
+            pdb.gimp_image_clean_all(image)
+
+
+def _read_pixels(drawable):
+    """Returns the pixels of drawable as a (height, width, channels) uint8 array, plus its fingerprint.
+
+    Indexed pixels are expanded to RGB(A) through the image colormap.
+    The fingerprint identifies the exact content.
+    """
+    import numpy as np
+    from zlib import crc32
+    w, h, bpp = drawable.width, drawable.height, drawable.bpp
+    data = drawable.get_pixel_rgn(0, 0, w, h, False, False)[0:w, 0:h]
+    fingerprint = '%dx%dx%d:%08x' % (w, h, bpp, crc32(data) & 0xffffffff)
+    pixels = np.frombuffer(data, dtype=np.uint8).reshape(h, w, bpp)
+    if drawable.is_indexed:
+        cmap = np.frombuffer(drawable.image.colormap, dtype=np.uint8).reshape(-1, 3)
+        rgb = cmap[pixels[..., 0]]
+        if bpp == 2:
+            rgb = np.dstack((rgb, pixels[..., 1]))
+        pixels = rgb
+    return pixels, fingerprint
+
+
+def _compute_stats(pixels, has_alpha):
+    """Compute LayerStats for a (height, width, channels) array.
+
+    area       number of pixels that aren't fully transparent
+    luminance  mean luminance (0..1) of those pixels, weighted by alpha
+    hue        centre (in degrees) of the most common 10-degree hue bin among saturated pixels,
+               or -1 if there are none (eg. grayscale content)
+    bbox       (x1, y1, x2, y2) bounds of the non-transparent pixels, in layer coordinates
+    """
+    import numpy as np
+    if has_alpha:
+        alpha = pixels[..., -1]
+        color = pixels[..., :-1]
+    else:
+        alpha = np.full(pixels.shape[:2], 255, dtype=np.uint8)
+        color = pixels
+    opaque = alpha > 0
+    area = int(np.count_nonzero(opaque))
+    if not area:
+        return LayerStats(0, 0.0, -1, (0, 0, 0, 0))
+    rows = np.flatnonzero(opaque.any(axis=1))
+    cols = np.flatnonzero(opaque.any(axis=0))
+    bbox = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+    weights = alpha[opaque].astype(np.float64)
+    color = color[opaque].astype(np.float64)
+    if color.shape[1] == 1:
+        return LayerStats(area, float(np.average(color[:, 0], weights=weights)) / 255., -1, bbox)
+    luma = color.dot([0.299, 0.587, 0.114])
+    luminance = float(np.average(luma, weights=weights)) / 255.
+    hi = color.max(axis=1)
+    delta = hi - color.min(axis=1)
+    # near-grays have no meaningful hue
+    chromatic = delta > 24
+    if not chromatic.any():
+        return LayerStats(area, luminance, -1, bbox)
+    r, g, b = color[chromatic].T
+    hi, delta, weights = hi[chromatic], delta[chromatic], weights[chromatic]
+    hue = np.where(hi == r, ((g - b) / delta) % 6,
+                   np.where(hi == g, (b - r) / delta + 2, (r - g) / delta + 4)) * 60
+    histogram = np.bincount((hue // 10).astype(np.intp) % 36, weights=weights, minlength=36)
+    return LayerStats(area, luminance, int(histogram.argmax()) * 10 + 5, bbox)
+
+
+def _serialize_stats(key, fingerprint, stats):
+    return '%s %s\n%d %r %d %d %d %d %d' % ((key, fingerprint, stats.area, stats.luminance, stats.hue) + tuple(stats.bbox))
+
+
+def _parse_stats(data):
+    header, values = data.split('\n', 1)
+    key, fingerprint = header.split(' ')
+    values = values.split()
+    return key, fingerprint, LayerStats(int(values[0]), float(values[1]), int(values[2]),
+                                   tuple([int(v) for v in values[3:7]]))
+
+
+def layer_stats(drawable, exact=False):
+    """Returns LayerStats for drawable's current content.
+
+    Results are kept in a persistent parasite on the layer, tagged with its _content_key() and
+    the fingerprint of its pixels. Normally they are trusted while the content key is unchanged,
+    so a later sort only reads the pixels of layers that have changed. The content key comes from
+    GIMP's preview, which small edits to a large layer may leave unchanged; so with exact (for
+    filters that remove layers), the pixels are always read, and the stats trusted only while the
+    fingerprint is unchanged.
+    Stats computed here are only attached by a later call to _save_stats().
+    """
+    key = _content_key(drawable)
+    pixels = fingerprint = None
+    if exact:
+        pixels, fingerprint = _read_pixels(drawable)
+    cached = _stats_cache.get(drawable.ID)
+    if cached is None:
+        p = drawable.parasite_find(STATS_PARASITE_NAME)
+        if p:
+            try:
+                cached = _parse_stats(p.data)
+            except (ValueError, IndexError):
+                cached = None
+    if cached and (cached[1] == fingerprint if exact else cached[0] == key):
+        _stats_cache[drawable.ID] = cached
+        return cached[2]
+    if pixels is None:
+        pixels, fingerprint = _read_pixels(drawable)
+    stats = _compute_stats(pixels, drawable.has_alpha)
+    _unsaved_stats[drawable.ID] = (drawable, _serialize_stats(key, fingerprint, stats))
+    _stats_cache[drawable.ID] = (key, fingerprint, stats)
+    return stats
+
+
+def _save_stats(image):
+    """Attach the stats computed by layer_stats() to their layers. Call it before the layers are removed."""
+    if not _unsaved_stats:
+        return
+    with _caching(image):
+        for layer, data in _unsaved_stats.values():
+            layer.parasite_attach(gimp.Parasite(STATS_PARASITE_NAME, PARASITE_PERSISTENT, data))
+    _unsaved_stats.clear()
+
+
+def content_key(drawable, by, distances=None):
+    """Returns the content-statistics sort key selected by 'by' (one of the BY_* constants).
+
+    BY_SIMILARITY looks drawable up in distances, as returned by similarity_to().
+    """
+    if by == BY_NOTHING:
+        return 0
+    elif by == BY_SIMILARITY:
+        return distances[drawable.ID]
+    stats = layer_stats(drawable)
+    if by == BY_AREA:
+        return stats.area
+    elif by == BY_LUMINANCE:
+        return stats.luminance
+    elif by == BY_HUE:
+        return stats.hue
+    x1, y1, x2, y2 = stats.bbox
+    return (x2 - x1) * (y2 - y1)
+
+
+def _thumbnail(drawable, size=32):
+    """Returns (key, gray) for GIMP's cached preview of drawable.
+
+    key changes whenever the preview does; gray is a float array of the preview composited over white.
+    """
+    import numpy as np
+    from zlib import crc32
+    w, h, bpp, count, data = pdb.gimp_drawable_thumbnail(drawable, size, size)
+    if isinstance(data, str):
+        data = np.frombuffer(data, dtype=np.uint8)
+    else:
+        data = np.array(data, dtype=np.uint8)
+    key = '%dx%dx%d:%08x' % (w, h, bpp, crc32(data.tostring()) & 0xffffffff)
+    pixels = data.reshape(h, w, bpp).astype(np.float64)
+    if bpp in (3, 4):
+        gray = pixels[..., :3].dot([0.299, 0.587, 0.114])
+    else:
+        gray = pixels[..., 0]
+    if bpp in (2, 4):
+        alpha = pixels[..., -1] / 255.
+        gray = gray * alpha + 255. * (1 - alpha)
+    return key, gray
+
+
+def _content_key(drawable):
+    """Returns a key that changes along with drawable's content, without reading its pixels.
+
+    It is made from the layer's tattoo, size and offsets, and the key of GIMP's preview of it (see _thumbnail).
+    """
+    return '%d:%dx%d%+d%+d:%s' % ((drawable.tattoo, drawable.width, drawable.height) + tuple(drawable.offsets)
+                                 + (_thumbnail(drawable)[0],))
+
+
+def _dhash(gray):
+    """64-bit difference hash of a 2d array: whether each of 8x9 area-averaged cells is brighter than its left neighbour."""
+    import numpy as np
+    h, w = gray.shape
+    # every cell must receive at least one source pixel
+    gray = np.repeat(np.repeat(gray, -(-8 // h), axis=0), -(-9 // w), axis=1)
+    h, w = gray.shape
+    rows = (np.arange(h) * 8 // h)[:, None]
+    cols = (np.arange(w) * 9 // w)[None, :]
+    sums = np.zeros((8, 9))
+    counts = np.zeros((8, 9))
+    np.add.at(sums, (rows, cols), gray)
+    np.add.at(counts, (rows, cols), 1)
+    cells = sums / counts
+    bits = (cells[:, 1:] > cells[:, :-1]).ravel()
+    return sum(1 << int(i) for i in np.flatnonzero(bits))
+
+
+def _load_index(image, name):
+    """Returns {layer tattoo: (key, value)} from the image parasite name, as written by _save_index()."""
+    index = {}
+    p = image.parasite_find(name)
+    if p:
+        for line in p.data.splitlines():
+            tattoo, key, value = line.split(' ')
+            index[int(tattoo)] = (key, value)
+    return index
+
+
+def _save_index(image, name, index):
+    """Attach index ({layer tattoo: (key, value)}, with hex string values) as the persistent image parasite name.
+
+    Entries for layers (and layer groups) that no longer exist are dropped.
+    """
+    live = set(l.tattoo for l in _items(image.layers))
+    data = '\n'.join(['%d %s %s' % (t, key, value) for t, (key, value) in sorted(index.items()) if t in live])
+    with _caching(image):
+        image.parasite_attach(gimp.Parasite(name, PARASITE_PERSISTENT, data))
+
+
+def perceptual_hashes(image, layers):
+    """Returns {layer ID: 64-bit dHash} for the given layers.
+
+    Hashes are computed from GIMP's drawable previews, and kept in a persistent image parasite
+    indexed by layer tattoo and preview key, so only layers whose preview has changed are rehashed.
+    """
+    index = dict((t, (key, int(value, 16))) for t, (key, value) in _load_index(image, PHASH_PARASITE_NAME).items())
+    result = {}
+    changed = False
+    for l in layers:
+        key, gray = _thumbnail(l)
+        cached = index.get(l.tattoo)
+        if cached and cached[0] == key:
+            result[l.ID] = cached[1]
+            continue
+        result[l.ID] = _dhash(gray)
+        index[l.tattoo] = (key, result[l.ID])
+        changed = True
+    if changed:
+        _save_index(image, PHASH_PARASITE_NAME, dict((t, (key, '%016x' % value)) for t, (key, value) in index.items()))
+    return result
+
+
+def hamming_distances(hashes, other=None):
+    """Returns the matrix of bit differences between the 64-bit hashes in 'hashes' and 'other' (default: hashes)."""
+    import numpy as np
+    a = np.array(hashes, dtype=np.uint64)
+    b = a if other is None else np.array(other, dtype=np.uint64)
+    xor = (a[:, None] ^ b[None, :])
+    bitcounts = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return bitcounts[xor.view(np.uint8)].reshape(xor.shape + (8,)).sum(axis=-1)
+
+
+def similarity_to(image, reference, layers):
+    """Returns {layer ID: number of perceptual hash bits differing from reference} for layers.
+
+    0 means identical at preview scale; unrelated images typically differ in about 32 of the 64 bits.
+    """
+    hashes = perceptual_hashes(image, list(layers) + [reference])
+    distances = hamming_distances([hashes[l.ID] for l in layers], [hashes[reference.ID]])
+    return dict((l.ID, int(d)) for l, d in zip(layers, distances[:, 0]))
+
+
+def _exact_duplicates(layers):
+    """Returns lists of layers with pixel-identical content.
+
+    Layers are compared by type and size first, then hashed one tile at a time;
+    a layer stops being read as soon as its content so far matches no other layer.
+    The digests aren't cached: the only cheap keys come from GIMP's previews, which small edits
+    to a large layer may leave unchanged, and a stale digest would remove a layer that has changed.
+    """
+    from hashlib import sha1
+    buckets = {}
+    for l in layers:
+        buckets.setdefault((l.width, l.height, l.type), []).append(l)
+    groups = []
+    tw, th = gimp.tile_width(), gimp.tile_height()
+    for (w, h, _), candidates in buckets.items():
+        if len(candidates) < 2:
+            continue
+        regions = dict((l.ID, l.get_pixel_rgn(0, 0, w, h, False, False)) for l in candidates)
+        hashers = dict((l.ID, sha1()) for l in candidates)
+        live = [candidates]
+        for y in range(0, h, th):
+            for x in range(0, w, tw):
+                split = []
+                for group in live:
+                    by_digest = {}
+                    for l in group:
+                        hasher = hashers[l.ID]
+                        hasher.update(regions[l.ID][x:min(x + tw, w), y:min(y + th, h)])
+                        by_digest.setdefault(hasher.digest(), []).append(l)
+                    split.extend([g for g in by_digest.values() if len(g) > 1])
+                live = split
+                if not live:
+                    break
+            if not live:
+                break
+        groups.extend(live)
+    return groups
+
+
+def _near_duplicates(image, layers, threshold):
+    """Returns lists of layers whose perceptual hashes differ by at most threshold bits (transitively)."""
+    import numpy as np
+    hashes = perceptual_hashes(image, layers)
+    close = hamming_distances([hashes[l.ID] for l in layers]) <= threshold
+    parent = list(range(len(layers)))
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in zip(*np.nonzero(np.triu(close, 1))):
+        parent[root(i)] = root(j)
+    groups = {}
+    for i, l in enumerate(layers):
+        groups.setdefault(root(i), []).append(l)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def _flatten(layerlist):
+    """Returns the non-group layers within layerlist, recursively, in stacking order (top first)."""
+    layers = []
+    for l in layerlist:
+        if pdb.gimp_item_is_group(l):
+            layers.extend(_flatten(l.children))
+        else:
+            layers.append(l)
+    return layers
+
+
+def _items(layerlist):
+    """Returns the layers and layer groups within layerlist, recursively."""
+    items = []
+    for l in layerlist:
+        items.append(l)
+        if pdb.gimp_item_is_group(l):
+            items.extend(_items(l.children))
+    return items
+
+
+def matches(drawable,  pattern, selection, content=IGNORE_CONTENT, similar=None):
     """Returns whether drawable matches the filter.
     
     Parameters
     -----------
     drawable   drawable to be checked
     pattern    compiled regexp
+    selection  IGNORE_SEL, IN_SEL or NOT_IN_SEL
+    content    IGNORE_CONTENT, EMPTY (no pixels that aren't fully transparent) or NOT_EMPTY
+    similar    None, or the set of IDs of layers that are similar enough to match
     custom     compiled CustomMatch object, specifying other criteria like layer mode, alpha channelness or opacity
     """
     if not pattern.match(drawable.name):
         return False
 
+    if similar is not None and drawable.ID not in similar:
+        return False
+
     # selection != 0: examine selection mask within layer bounds
     #                 if it contains nonzero pixels, set in_selection = True
     #
@@ -66,7 +476,12 @@ def matches(drawable,  pattern, selection):
        in_selection = sum(a) > 0
        if selection == NOT_IN_SEL:
            in_selection = not in_selection
-       return in_selection
+       if not in_selection:
+           return False
+
+    if content != IGNORE_CONTENT:
+        empty = layer_stats(drawable, exact=True).area == 0
+        return empty if content == EMPTY else not empty
     return True
     
 
@@ -92,18 +507,29 @@ def sort_key(priority, *args):
 #XXX select_channels?
 
 # Custom criteria aren't implemented yet.
-def select_layers(image, drawable, action, patterntype, pattern, selection):
+def select_layers(image, drawable, action, patterntype, pattern, selection, content=IGNORE_CONTENT, similarity=-1):
     import re
-    pdb.gimp_image_undo_group_start(image)
+    if not drawable:
+        drawable = image.active_layer
     old = list(image.layers)
     pattern = compile_pattern(patterntype, pattern)
+    similar = None
+    if similarity >= 0 and drawable:
+        distances = similarity_to(image, drawable, old)
+        similar = set(k for k, v in distances.items() if v <= similarity)
+    doomed = []
     for l in old:
-        m = matches(l, pattern, selection)
+        m = matches(l, pattern, selection, content, similar)
         if action == DISCARD:
             m = not m
         if m is not True:
-            image.remove_layer(l)
-    
+            doomed.append(l)
+    # caches are attached outside the undo group, so it only holds the removals
+    _save_stats(image)
+    pdb.gimp_image_undo_group_start(image)
+    for l in doomed:
+        image.remove_layer(l)
+
     pdb.gimp_progress_end()
     pdb.gimp_image_undo_group_end(image)
 
@@ -131,17 +557,49 @@ def rename_layers(image, drawable, action, patterntype, pattern, separator, name
     pdb.gimp_image_undo_group_end(image)
 
 
-def sort_layers(image, drawable, scope, patterntype, pattern, priority, reverse):
+def sort_layers(image, drawable, scope, patterntype, pattern, priority, reverse, by=BY_NOTHING):
     if not drawable:
         drawable = image.active_drawable
     pattern = compile_pattern(patterntype, pattern)
     # scope is either 'current group' or 'entire image'
     todo = _affected_layers(image, scope)
-    pdb.gimp_image_undo_group_start(image)
+    distances = None
+    if by == BY_SIMILARITY:
+        # similarity is to the active layer, even when a channel or mask is the active drawable
+        distances = similarity_to(image, image.active_layer, [l for depth, parent, layers in todo for l in layers])
+    presorts = []
     for depth, parent, layers in todo:
-        presort = [(l, sort_key(priority, pattern.findall(l.name), l.name, l.width * l.height)) for l in layers]
-        _applysort(image, [l for l, key in sorted(presort, reverse=reverse)])
+        presort = [(l, (content_key(l, by, distances),) + sort_key(priority, pattern.findall(l.name), l.name, l.width * l.height))
+                   for l in layers]
+        presorts.append((parent, presort))
+    _save_stats(image)
+    pdb.gimp_image_undo_group_start(image)
+    for parent, presort in presorts:
+        _applysort(image, parent, [l for l, key in sorted(presort, key=lambda v: v[1], reverse=reverse)])
+    pdb.gimp_image_undo_group_end(image)
+
+def remove_duplicates(image, drawable, scope, near, threshold):
+    """Remove all but the topmost layer of each set of duplicate layers."""
+    if scope == ACTIVEGROUP:
+        if not pdb.gimp_item_is_group(image.active_layer):
+            return
+        layers = _flatten(image.active_layer.children)
+    else:
+        layers = _flatten(image.layers)
+    groups = _exact_duplicates(layers)
+    if near:
+        groups.extend(_near_duplicates(image, layers, threshold))
+    order = dict((l.ID, i) for i, l in enumerate(layers))
+    doomed = {}
+    for group in groups:
+        group = sorted(group, key=lambda l: order[l.ID])
+        for l in group[1:]:
+            doomed[l.ID] = l
+    pdb.gimp_image_undo_group_start(image)
+    for l in doomed.values():
+        image.remove_layer(l)
     pdb.gimp_image_undo_group_end(image)
+    pdb.gimp_message('Removed %d duplicate layers.' % len(doomed))
 
 def swap_names(image, drawable, otherlayer):
     if not drawable:
@@ -182,6 +640,12 @@ register(
                _("Intersects layer bounds"),
                _("Doesn't intersect layer bounds"),
               )),
+            (PF_OPTION, "content", "Content:", 0,
+              (_("Ignore"),
+               _("Empty (fully transparent)"),
+               _("Not empty"),
+              )),
+            (PF_INT, "similarity", "Max. difference from active layer (bits of 64, -1 = ignore):", -1),
             ],
     results=[],
     function=select_layers,
@@ -221,8 +685,8 @@ register(
 
 register(
     proc_name="python-fu-sort-layers",
-    blurb="Sort layers by name/size/regexp|glob-pattern)",
-    help=("Sort layers by name/size/regexp|glob-pattern)"),
+    blurb="Sort layers by name/size/regexp|glob-pattern|content statistics)",
+    help=("Sort layers by name/size/regexp|glob-pattern|content statistics)"),
     author="David Gowers",
     copyright="David Gowers",
     date=("2015"),
@@ -244,6 +708,13 @@ register(
                _("size, regexp, name"),
                _("name, size, regexp"))),
             (PF_BOOL, "reverse", "Reverse sort", 1),
+            (PF_OPTION, "by", "Sort first by content", 0,
+              (_("Nothing"),
+               _("Non-transparent area"),
+               _("Mean luminance"),
+               _("Dominant hue"),
+               _("Alpha bounding box area"),
+               _("Similarity to active layer"))),
             ],
     results=[],
     function=sort_layers,
@@ -252,6 +723,33 @@ register(
     )
 
 
+register(
+    proc_name="python-fu-remove-duplicate-layers",
+    blurb="Remove layers whose content duplicates a layer above them",
+    help=("Layers with pixel-identical content are always considered duplicates. If near is true, "
+          "layers whose perceptual hashes differ by at most threshold bits (of 64) are too. "
+          "The topmost layer of each set of duplicates is kept."),
+    author="David Gowers",
+    copyright="David Gowers",
+    date=("2015"),
+    label=("Remove Duplicate Layers.."),
+    imagetypes=("*"),
+    params=[
+            (PF_IMAGE, "image", "_Image", None),
+            (PF_LAYER, "drawable", "_Drawable", None),
+            (PF_OPTION, "scope", "Scope", 1,
+              (_("Current group (recursively)"),
+               _("All layers (recursively)"))),
+            (PF_BOOL, "near", "Also remove _near-duplicates", 0),
+            (PF_INT, "threshold", "Near-duplicate _threshold (bits)", 4),
+            ],
+    results=[],
+    function=remove_duplicates,
+    menu=("<Image>/Layer/"),
+    domain=("gimp20-python", gimp.locale_directory)
+    )
+
+
 register(
     proc_name="python-fu-swap-layer-names",
     blurb="Swap the names of two layers",
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Stand-in for 'gimp -i', used by the tests of copynaut_batch.py.
+#
+# Runs the first -b argument as Python, with a pdb that pretends to load and export each file,
+# writing messages like copynaut's end-of-batch report to stderr as GIMP does in batch mode.
+# What happens depends on the file name:
+#
+#   *bad*    loading the file fails
+#   *crash*  the worker exits with status 3 while exporting the file
+#   *fail*   some of the exports fail
+#   *env*    also reports COPYNAUT_ENCODE_PROCESSES, as a message
+#
+# Anything else exports successfully.
+
+import os
+import sys
+
+
+class _Image(object):
+    active_drawable = 'drawable'
+    layers = ['drawable']
+
+
+class _PDB(object):
+    def __init__(self):
+        self.filename = None
+
+    def gimp_message_set_handler(self, handler):
+        pass
+
+    def gimp_file_load(self, filename, raw_filename):
+        self.filename = os.path.basename(filename)
+        if 'bad' in self.filename:
+            raise RuntimeError('Could not open %s' % filename)
+        return _Image()
+
+    def gimp_image_delete(self, image):
+        pass
+
+    def _export(self, written, skipped):
+        if 'crash' in self.filename:
+            sys.stdout.flush()
+            os._exit(3)
+        message = 'Exported %d files (%.1f kB).' % (written, written / 2.)
+        if skipped:
+            message += ' %d unchanged clippings skipped.' % skipped
+        if 'fail' in self.filename:
+            message += ' 2 exports failed.'
+        sys.stderr.write('copynaut-Message: %s\n' % message)
+        if 'env' in self.filename:
+            sys.stderr.write('copynaut-Message: encode processes %s\n' % os.environ.get('COPYNAUT_ENCODE_PROCESSES'))
+
+    def python_fu_export_clippings_from_vectors(self, image, drawable, *args):
+        self._export(3, 1)
+
+    def python_fu_export_layers(self, image, drawable, *args):
+        self._export(2, 0)
+
+
+if __name__ == '__main__':
+    code = sys.argv[sys.argv.index('-b') + 1]
+    exec(code, {'pdb': _PDB()})
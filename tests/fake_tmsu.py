@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# Stand-in for tmsu, used by the tests.
+#
+# Appends each invocation (arguments and working directory) to the file named by $FAKE_TMSU_LOG,
+# as a line of JSON. 'tmsu tags -- DIR' answers with the tags $FAKE_TMSU_DIRTAGS (a JSON object)
+# gives for DIR's basename, if any.
+
+import json
+import os
+import sys
+
+args = sys.argv[1:]
+with open(os.environ['FAKE_TMSU_LOG'], 'a') as f:
+    f.write(json.dumps({'args': args, 'cwd': os.getcwd()}) + '\n')
+if args[:1] == ['tags']:
+    dirtags = json.loads(os.environ.get('FAKE_TMSU_DIRTAGS', '{}'))
+    print('%s: %s' % (args[-1], dirtags.get(os.path.basename(args[-1]), '')))
@@ -0,0 +1,182 @@
+# Tests for copynaut_batch.py, the command-line batch driver, using tests/fake_gimp.py in place of GIMP.
+
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import copynaut_batch
+
+
+def _lines(*parts):
+    return '\n'.join(parts) + '\n'
+
+
+class DistributeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _file(self, name, size):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_balances_total_size(self):
+        files = [self._file('f%d' % i, size) for i, size in enumerate((900, 500, 400, 300, 200, 100))]
+        groups = copynaut_batch.distribute(files, 2)
+        self.assertEqual(sorted(f for g in groups for f in g), sorted(files))
+        loads = sorted(sum(os.path.getsize(f) for f in g) for g in groups)
+        self.assertEqual(loads, [1200, 1200])
+        # largest first
+        self.assertEqual(groups[0][0], files[0])
+
+    def test_no_more_workers_than_files(self):
+        files = [self._file('a', 10), self._file('b', 20)]
+        groups = copynaut_batch.distribute(files, 8)
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(sorted(len(g) for g in groups), [1, 1])
+
+    def test_equal_sizes_spread_by_count(self):
+        files = [self._file('f%d' % i, 0) for i in range(5)]
+        groups = copynaut_batch.distribute(files, 2)
+        self.assertEqual(sorted(len(g) for g in groups), [2, 3])
+
+    def test_missing_files_count_as_empty(self):
+        files = [self._file('a', 10), os.path.join(self.dir, 'missing')]
+        groups = copynaut_batch.distribute(files, 1)
+        self.assertEqual(groups, [files])
+
+
+class ParseOutputTest(unittest.TestCase):
+    begin = staticmethod(lambda f: copynaut_batch.BEGIN + json.dumps({'file': f}))
+    end = staticmethod(lambda f, **kw: copynaut_batch.END + json.dumps(dict(dict(file=f, status='ok', error=None,
+                                                                                 seconds=0.5), **kw)))
+
+    def test_counts_report_messages(self):
+        output = _lines(self.begin('/a.xcf'),
+                        'copynaut-Message: Exported 3 files (1.5 kB). 1 unchanged clippings skipped.',
+                        'copynaut-Message: Exported 1 files (0.5 kB). 2 exports failed.',
+                        self.end('/a.xcf'))
+        [a] = copynaut_batch.parse_output(output, ['/a.xcf'])
+        self.assertEqual((a['status'], a['written'], a['nbytes'], a['skipped'], a['failed']),
+                         ('ok', 4, 2048, 1, 2))
+        self.assertEqual(len(a['messages']), 2)
+
+    def test_worker_dying_mid_file(self):
+        output = _lines('GIMP startup noise',
+                        self.begin('/a.xcf'), self.end('/a.xcf'),
+                        self.begin('/b.xcf'), 'copynaut-Message: Exported 1 files (0.5 kB).')
+        a, b, c = copynaut_batch.parse_output(output, ['/a.xcf', '/b.xcf', '/c.xcf'])
+        self.assertEqual(a['status'], 'ok')
+        self.assertEqual(a['messages'], [])
+        self.assertEqual((b['status'], b['error'], b['written']), ('failed', 'worker stopped', 1))
+        self.assertEqual((c['status'], c['error'], c['written']), ('failed', 'not started', 0))
+
+    def test_failed_file(self):
+        output = _lines(self.begin('/a.xcf'), self.end('/a.xcf', status='failed', error='RuntimeError: nope'))
+        [a] = copynaut_batch.parse_output(output, ['/a.xcf'])
+        self.assertEqual((a['status'], a['error']), ('failed', 'RuntimeError: nope'))
+
+
+@unittest.skipIf(os.name != 'posix', 'the stand-in GIMP is run through a shell script')
+class MainTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # run the stand-in with this interpreter, whatever 'python' is on the PATH
+        self.gimp = os.path.join(self.dir, 'gimp')
+        with open(self.gimp, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(HERE, 'fake_gimp.py')))
+        os.chmod(self.gimp, os.stat(self.gimp).st_mode | stat.S_IXUSR)
+        self.report = os.path.join(self.dir, 'report.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _files(self, *names):
+        paths = []
+        for name in names:
+            path = os.path.join(self.dir, name)
+            open(path, 'w').close()
+            paths.append(path)
+        return paths
+
+    def _main(self, *args):
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+        try:
+            status = copynaut_batch.main(['--gimp', self.gimp, '--report', self.report] + list(args))
+        finally:
+            sys.stdout.close()
+            sys.stdout, sys.stderr = stdout, stderr
+        with open(self.report) as f:
+            return status, json.load(f)
+
+    def test_success(self):
+        files = self._files('a.xcf', 'b.xcf', 'c.xcf')
+        status, report = self._main('-j', '2', *files)
+        self.assertEqual(status, 0)
+        self.assertEqual([r['file'] for r in report['files']], files)
+        self.assertEqual([r['status'] for r in report['files']], ['ok'] * 3)
+        totals = report['totals']
+        self.assertEqual((totals['files'], totals['failed_files'], totals['workers']), (3, 0, 2))
+        self.assertEqual((totals['written'], totals['skipped'], totals['failed']), (9, 3, 0))
+
+    def test_layers(self):
+        status, report = self._main('--layers', *self._files('a.xcf'))
+        self.assertEqual(status, 0)
+        self.assertEqual(report['totals']['written'], 2)
+
+    def test_encode_processes(self):
+        status, report = self._main(*self._files('env.xcf'))
+        self.assertIn('encode processes 1', report['files'][0]['messages'][-1])
+        status, report = self._main('--encode-processes', '0', *self._files('env.xcf'))
+        self.assertIn('encode processes 0', report['files'][0]['messages'][-1])
+
+    def test_failed_load(self):
+        files = self._files('a.xcf', 'bad.xcf')
+        status, report = self._main('-j', '1', *files)
+        self.assertEqual(status, 1)
+        a, bad = report['files']
+        self.assertEqual(a['status'], 'ok')
+        self.assertEqual(bad['status'], 'failed')
+        self.assertIn('Could not open', bad['error'])
+
+    def test_failed_exports(self):
+        status, report = self._main(*self._files('fail.xcf'))
+        self.assertEqual(status, 1)
+        self.assertEqual(report['files'][0]['status'], 'ok')
+        self.assertEqual(report['totals']['failed'], 2)
+
+    def test_worker_crash(self):
+        # one worker, so the file after the crash is never started
+        files = self._files('a.xcf', 'crash.xcf', 'z.xcf')
+        with open(files[1], 'w') as f:
+            f.write('x' * 10)
+        with open(files[0], 'w') as f:
+            f.write('x' * 20)
+        status, report = self._main('-j', '1', *files)
+        self.assertEqual(status, 1)
+        a, crash, z = report['files']
+        self.assertEqual(a['status'], 'ok')
+        self.assertEqual((crash['status'], crash['error']), ('failed', 'worker stopped (exit status 3)'))
+        self.assertEqual((z['status'], z['error']), ('failed', 'not started (exit status 3)'))
+
+    def test_missing_gimp(self):
+        self.gimp = os.path.join(self.dir, 'no-such-gimp')
+        status, report = self._main(*self._files('a.xcf'))
+        self.assertEqual(status, 1)
+        self.assertIn('could not run', report['files'][0]['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
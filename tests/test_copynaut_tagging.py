@@ -0,0 +1,108 @@
+# Tests for copynaut's bulk TMSU tagging, against tests/fake_tmsu.py.
+#
+# copynaut is a GIMP plug-in, so these only run where gimpfu can be imported.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+try:
+    import copynaut
+except ImportError:
+    copynaut = None
+
+
+class _Image(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.ID = 1
+
+
+class _PDB(object):
+    """Collects GIMP messages."""
+    def __init__(self):
+        self.messages = []
+
+    def gimp_message(self, message):
+        self.messages.append(message)
+
+
+@unittest.skipIf(copynaut is None, 'copynaut needs gimpfu')
+class BulkTaggingTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'tmsu.log')
+        os.environ['FAKE_TMSU_LOG'] = self.log
+        os.environ['FAKE_TMSU_DIRTAGS'] = json.dumps({'photos': 'photo scan'})
+        profile = os.path.join(self.dir, 'profile')
+        os.makedirs(os.path.join(profile, 'copynaut'))
+        with open(os.path.join(profile, 'copynaut', 'config.ini'), 'w') as f:
+            f.write('[export]\ntmsu = %s\nencode processes = 1\n' % os.path.join(HERE, 'fake_tmsu.py'))
+        self.saved = copynaut.gimp.directory, copynaut.pdb
+        copynaut.gimp.directory = profile
+        copynaut.pdb = _PDB()
+        copynaut._config_cache = None
+
+    def tearDown(self):
+        copynaut.gimp.directory, copynaut.pdb = self.saved
+        copynaut._config_cache = None
+        shutil.rmtree(self.dir)
+
+    def _touch(self, *parts):
+        path = os.path.join(self.dir, *parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        return path
+
+    def _calls(self):
+        with open(self.log) as f:
+            return [json.loads(line) for line in f]
+
+    def test_one_call_per_directory_and_tag_set(self):
+        source = self._touch('source.xcf')
+        mtime = time.mktime((2010, 6, 1, 12, 0, 0, 0, 0, -1))
+        os.utime(source, (mtime, mtime))
+        photos = [self._touch('photos', name) for name in ('a.png', 'b.png', 'c.png')]
+        other = [self._touch('other', name) for name in ('d.png', 'e.png')]
+
+        image = _Image(source)
+        conf = copynaut._load_config(source)
+        stats = []
+        real_stat = os.stat
+        def counting_stat(path, *args):
+            if path == source:
+                stats.append(path)
+            return real_stat(path, *args)
+        os.stat = counting_stat
+        try:
+            with copynaut.export_batch(image):
+                for path in photos + other:
+                    copynaut.apply_src_tag(conf, path, image, None)
+                # nothing is tagged until the batch ends
+                self.assertEqual([c for c in self._calls() if c['args'][:2] == ['-v', 'tag']], [])
+        finally:
+            os.stat = real_stat
+
+        calls = self._calls()
+        tags = sorted(c['cwd'] for c in calls if c['args'][:1] == ['tags'])
+        self.assertEqual(tags, sorted(os.path.realpath(os.path.join(self.dir, d)) for d in ('other', 'photos')))
+        tag = sorted((c['cwd'], c['args']) for c in calls if c['args'][:2] == ['-v', 'tag'])
+        self.assertEqual(tag, sorted([
+            (os.path.realpath(os.path.join(self.dir, 'other')), ['-v', 'tag', '--tags=2010', '--'] + other),
+            (os.path.realpath(os.path.join(self.dir, 'photos')), ['-v', 'tag', '--tags=photo scan 2010', '--'] + photos),
+            ]))
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(copynaut.pdb.messages, [])
+
+
+if __name__ == '__main__':
+    unittest.main()